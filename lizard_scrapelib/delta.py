@@ -0,0 +1,142 @@
+"""
+State of earlier PI-XML exports, so an export only has to contain the events
+that are new or changed since the last one.
+
+Every series (locationId, parameterId) is cut into calendar months and a
+hash of the times, values and flags of each month is kept in a SQLite
+database. A month whose hash is unchanged is left out of the next export, a
+new or changed month is exported as a whole.
+"""
+import bisect
+import datetime
+import hashlib
+import sqlite3
+
+try:
+    import series as series_
+except ImportError:
+    from lizard_scrapelib import series as series_
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    location_id TEXT NOT NULL,
+    parameter_id TEXT NOT NULL,
+    block INTEGER NOT NULL,
+    hash BLOB NOT NULL,
+    PRIMARY KEY (location_id, parameter_id, block)
+) WITHOUT ROWID
+"""
+
+
+def month_start(year, month):
+    return series_.to_timestamp(datetime.datetime(year, month, 1))
+
+
+def month_blocks(values):
+    """
+    Yields (block, first, last) for every month with events in a Series
+    sorted on time, block is year * 12 + month - 1 and events[first:last]
+    fall in that month.
+    """
+    stats = values.stats()
+    if not stats.count:
+        return
+    block = stats.start.year * 12 + stats.start.month - 1
+    last_block = stats.end.year * 12 + stats.end.month - 1
+    first = 0
+    while block <= last_block:
+        year, month = divmod(block + 1, 12)
+        last = bisect.bisect_left(values.times, month_start(year, month + 1),
+                                  first)
+        if last > first:
+            yield block, first, last
+        block += 1
+        first = last
+
+
+def block_hash(values, first, last):
+    digest = hashlib.blake2b(digest_size=16)
+    for column in (values.times, values.values, values.flags):
+        digest.update(column[first:last].tobytes())
+    return digest.digest()
+
+
+class ExportState(object):
+    """
+    Block hashes of the series exported before, stored in the SQLite file at
+    path. Use it as a context manager around the export: the new hashes are
+    committed when the export succeeds and rolled back when it fails, so a
+    failed export is repeated in full next time.
+
+        with delta.ExportState('export_state.sqlite') as state:
+            pixml.create(headerdicts, values, filename, state=state)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+
+    def delta(self, location_id, parameter_id, values):
+        """
+        The events of values in months that are new or changed since the
+        last export, and records their hashes. Months within the span of
+        values that no longer have events are forgotten; months outside it
+        are left alone, so exports of parts of a series (e.g. one year)
+        do not undo each other.
+
+        Args:
+            values: series.Series or an iterable of {datetime, value, flag}
+                dicts.
+
+        Returns:
+            series.Series sorted on time, empty when nothing changed.
+        """
+        if not isinstance(values, series_.Series):
+            values = series_.Series.from_events(values)
+        values.sort()
+        known = dict(self.connection.execute(
+            "SELECT block, hash FROM blocks "
+            "WHERE location_id = ? AND parameter_id = ?",
+            (location_id, parameter_id)))
+        changes = series_.Series(missing_value=values.missing_value)
+        updates = []
+        for block, first, last in month_blocks(values):
+            digest = block_hash(values, first, last)
+            if known.pop(block, None) == digest:
+                continue
+            updates.append((location_id, parameter_id, block, digest))
+            changes.frombytes(values.times[first:last].tobytes(),
+                              values.values[first:last].tobytes(),
+                              values.flags[first:last].tobytes())
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?)", updates)
+        stats = values.stats()
+        if stats.count:
+            first_block = stats.start.year * 12 + stats.start.month - 1
+            last_block = stats.end.year * 12 + stats.end.month - 1
+            self.connection.executemany(
+                "DELETE FROM blocks WHERE location_id = ? AND "
+                "parameter_id = ? AND block = ?",
+                ((location_id, parameter_id, block) for block in known
+                 if first_block <= block <= last_block))
+        return changes
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        self.close()
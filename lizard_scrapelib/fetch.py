@@ -0,0 +1,309 @@
+"""
+Concurrent HTTP fetching with keep-alive connections.
+
+A Fetcher keeps a small pool of persistent http.client connections per host,
+fetches from a bounded pool of threads and waits between requests to the
+same host, so scraping many pages of one site does not open a connection per
+page or hammer the server. With a Cache pages are kept on disk and
+revalidated with conditional requests.
+"""
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import http.client
+import json
+import os
+import queue
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+USER_AGENT = "lizard-scrapelib"
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+Response = collections.namedtuple('Response', ['url', 'status', 'headers',
+                                               'body'])
+
+
+def decode(response):
+    """Text of a Response in the charset it declares, UTF-8 otherwise."""
+    encoding = response.headers.get_content_charset()
+    return response.body.decode(encoding if encoding else 'UTF-8')
+
+
+class HostPool(object):
+    """
+    Keep-alive connections to one host, at most connections of them in use
+    at the same time. A connection that fails is closed instead of returned
+    to the pool.
+    """
+
+    def __init__(self, scheme, netloc, connections=4, timeout=60):
+        self.connection_class = http.client.HTTPSConnection if \
+            scheme == 'https' else http.client.HTTPConnection
+        self.netloc = netloc
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(connections)
+        self.idle = queue.LifoQueue()
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                connection = self.connection_class(
+                    self.netloc, timeout=self.timeout)
+            try:
+                yield connection
+            except Exception:
+                connection.close()
+                raise
+            self.idle.put(connection)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class RateLimit(object):
+    """Spaces the requests to one host at least interval seconds apart."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_request = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request)
+            self.next_request = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class Cache(object):
+    """
+    Responses on disk in directory, keyed by url. Every entry is a .body
+    file with the content and a .json file with the url, the time it was
+    stored and the response headers, among which ETag and Last-Modified
+    for revalidation.
+
+    Entries younger than max_age seconds are used without asking the
+    server. Older entries are revalidated with If-None-Match and
+    If-Modified-Since. When the bodies grow past max_bytes the least
+    recently used entries are removed. In offline mode only the cache is
+    used, whatever the age of an entry.
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 28, max_age=None,
+                 offline=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.offline = offline
+        self.lock = threading.Lock()
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(
+            url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        """
+        Returns:
+            (metadata, Response) for a cached url or (None, None).
+        """
+        path = self.path(url)
+        try:
+            with open(path + '.json') as f:
+                metadata = json.load(f)
+            with open(path + '.body', 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None, None
+        headers = http.client.HTTPMessage()
+        for name, value in metadata["headers"]:
+            headers[name] = value
+        return metadata, Response(url, 200, headers, body)
+
+    def touch(self, url):
+        """Marks the entry for url as used, for the LRU eviction."""
+        try:
+            os.utime(self.path(url) + '.body')
+        except OSError:
+            pass
+
+    def put(self, response):
+        path = self.path(response.url)
+        metadata = {"url": response.url, "stored": time.time(),
+                    "headers": list(response.headers.items())}
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            for extension, data in (('.body', response.body), ('.json', (
+                    json.dumps(metadata)).encode('utf-8'))):
+                with open(path + extension + '.part', 'wb') as f:
+                    f.write(data)
+                os.replace(path + extension + '.part', path + extension)
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.body'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name[:-5]))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, key in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            for extension in ('.json', '.body'):
+                try:
+                    os.remove(os.path.join(self.directory, key + extension))
+                except FileNotFoundError:
+                    pass
+            size -= entry_size
+
+    def fetch(self, url, get):
+        """
+        Response for url from the cache, revalidated or refreshed with
+        get(url, headers) when needed.
+        """
+        metadata, cached = self.get(url)
+        if self.offline or (cached is not None and self.max_age is not None
+                            and time.time() - metadata["stored"] <
+                            self.max_age):
+            if cached is None:
+                raise urllib.error.URLError(
+                    'offline and {} is not in the cache'.format(url))
+            self.touch(url)
+            return cached
+        headers = {}
+        if cached is not None:
+            if cached.headers.get("ETag"):
+                headers["If-None-Match"] = cached.headers["ETag"]
+            if cached.headers.get("Last-Modified"):
+                headers["If-Modified-Since"] = cached.headers["Last-Modified"]
+        response = get(url, headers)
+        if response.status == 304 and cached is not None:
+            self.put(cached)
+            return cached
+        # Stored under the url asked for, not the one redirected to, so the
+        # next fetch of url finds it.
+        response = response._replace(url=url)
+        self.put(response)
+        return response
+
+
+class Fetcher(object):
+    """
+    Fetches urls over pooled keep-alive connections from a pool of workers
+    threads. Per host at most connections requests are in flight and at most
+    requests_per_second are started. With a Cache, text() and map() go
+    through the cache.
+
+        with fetch.Fetcher(workers=8) as fetcher:
+            pages = fetcher.map(urls)
+    """
+
+    def __init__(self, workers=8, connections=4, requests_per_second=4.0,
+                 timeout=60, retries=3, cache=None):
+        self.workers = workers
+        self.connections = connections
+        self.interval = 1.0 / requests_per_second if requests_per_second \
+            else 0.0
+        self.timeout = timeout
+        self.retries = retries
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.executor = None
+
+    def host(self, scheme, netloc):
+        with self.lock:
+            key = scheme, netloc
+            if key not in self.hosts:
+                self.hosts[key] = (
+                    HostPool(scheme, netloc, self.connections, self.timeout),
+                    RateLimit(self.interval))
+            return self.hosts[key]
+
+    def request(self, url, headers=None):
+        """One GET of url without following redirects, retried on a fresh
+        connection when a kept-alive connection turns out to be closed."""
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+        request_headers = {"User-Agent": USER_AGENT}
+        request_headers.update(headers or {})
+        pool, rate_limit = self.host(parts.scheme, parts.netloc)
+        for attempt in range(self.retries + 1):
+            rate_limit.wait()
+            try:
+                with pool.connection() as connection:
+                    connection.request('GET', path, headers=request_headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                    if response.will_close:
+                        connection.close()
+                return Response(url, response.status, response.headers, body)
+            except (http.client.HTTPException, OSError) as error:
+                if attempt == self.retries:
+                    raise
+                print('retrying', url, 'after', repr(error))
+
+    def get(self, url, headers=None):
+        """
+        GETs url, following redirects.
+
+        Returns:
+            Response; a 304 Not Modified is returned as is.
+
+        Raises:
+            urllib.error.HTTPError for a 4xx or 5xx status, like urlopen.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self.request(url, headers)
+            if response.status not in REDIRECTS:
+                break
+            url = urllib.parse.urljoin(url, response.headers["Location"])
+        if response.status >= 400:
+            raise urllib.error.HTTPError(
+                url, response.status, http.client.responses.get(
+                    response.status, ''), response.headers, None)
+        return response
+
+    def text(self, url):
+        if self.cache is not None:
+            return decode(self.cache.fetch(url, self.get))
+        return decode(self.get(url))
+
+    def map(self, urls, function=None):
+        """
+        Fetches all urls concurrently and yields function(url) (text(url)
+        by default) in the order of urls while later urls are still being
+        fetched.
+        """
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.workers)
+        return self.executor.map(function or self.text, urls)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        for pool, _ in self.hosts.values():
+            pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
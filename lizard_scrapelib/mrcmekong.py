@@ -1,20 +1,25 @@
+import collections
+import concurrent.futures
 import csv
 import datetime
+import json
+import multiprocessing
 import os
 import pickle
 import re
-import urllib.request
 import zipfile
 
 from lxml import etree
-from osgeo import ogr
-from osgeo import osr
 
-import lizard_connector
 import lizard_scrapelib.pixml
+from lizard_scrapelib import fetch
+from lizard_scrapelib import series
 
+# osgeo, lizard_connector and the secrets module with the Lizard USR and PWD
+# are imported by the functions that need them, so that importing this
+# module does not need them.
 
-from secrets import *
+LIZARD_URL = "http://integration.nxt.lizard.net"
 
 missing_dry = ['Thakhek', 'Savanakhet', 'Phnom Penh Port']
 
@@ -397,26 +402,94 @@ station_locations = {
 
 station_names = {k: station_locations[k][0] for k in stations.keys()}
 
-source = osr.SpatialReference()
-source.ImportFromEPSG(32648)
-target = osr.SpatialReference()
-target.ImportFromEPSG(4326)
-transform = osr.CoordinateTransformation(source, target)
-
-
-stations_wgs84 = {}
+SOURCE_EPSG = 32648
+TARGET_EPSG = 4326
+REPROJECTION_CACHE = 'mrcmekong_reprojection.json'
+
+
+def spatial_reference(epsg):
+    from osgeo import osr
+    reference = osr.SpatialReference()
+    reference.ImportFromEPSG(epsg)
+    if hasattr(reference, 'SetAxisMappingStrategy'):
+        # GDAL 3 follows the axis order of the EPSG definition (lat, lon for
+        # 4326), keep x = lon and y = lat like GDAL 2 did.
+        reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return reference
+
+
+def reproject(points, source_epsg=SOURCE_EPSG, target_epsg=TARGET_EPSG,
+              cache_path=REPROJECTION_CACHE):
+    """
+    Transforms (x, y) points from source_epsg to target_epsg. Points are
+    looked up in a json table at cache_path keyed by the EPSG pair and the
+    coordinates; the ones that are not there are transformed in one
+    TransformPoints call and added to it.
+
+    Returns:
+        list of (x, y) in target_epsg, for 4326 (lon, lat).
+    """
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        cache = {}
+    keys = ['{}:{}:{!r}:{!r}'.format(source_epsg, target_epsg, x, y)
+            for x, y in points]
+    missing = {key: point for key, point in zip(keys, points)
+               if key not in cache}
+    if missing:
+        from osgeo import osr
+        transform = osr.CoordinateTransformation(
+            spatial_reference(source_epsg), spatial_reference(target_epsg))
+        for key, transformed in zip(missing, transform.TransformPoints(
+                [tuple(point) for point in missing.values()])):
+            cache[key] = list(transformed[:2])
+        with open(cache_path + '.part', 'w') as cache_file:
+            json.dump(cache, cache_file, indent=1, sort_keys=True)
+        os.replace(cache_path + '.part', cache_path)
+    return [tuple(cache[key]) for key in keys]
+
+
+_stations_wgs84 = {}
+
+
+def wgs84_stations():
+    """
+    {station: {"WKT", "lon", "lat"}} of station_locations in WGS84,
+    reprojected on first use.
+    """
+    if not _stations_wgs84:
+        names = list(station_locations)
+        for name, (lon, lat) in zip(names, reproject(
+                [station_locations[name][1] for name in names])):
+            _stations_wgs84[name] = {
+                "WKT": 'POINT ({!r} {!r})'.format(lon, lat),
+                "lon": lon, "lat": lat}
+    return _stations_wgs84
+
+
+def credentials():
+    """USR and PWD for Lizard from the secrets module."""
+    from secrets import USR, PWD
+    return USR, PWD
+
+
+def lizard_endpoint(endpoint):
+    """A lizard_connector endpoint on LIZARD_URL with credentials()."""
+    import lizard_connector
+    username, password = credentials()
+    return lizard_connector.connector._Endpoint(
+        base=LIZARD_URL,
+        endpoint=endpoint,
+        username=username,
+        password=password
+    )
 
-for station, (_, c) in station_locations.items():
-    lon, lat = c
-    wkt = lizard_connector.queries.point(lon, lat)
-    point = ogr.CreateGeometryFromWkt(wkt)
-    point.Transform(transform)
-    new_wkt = point.ExportToWkt()
-    lon, lat = re.findall("[\d\.]+", new_wkt)
-    stations_wgs84[station] = {"WKT": new_wkt, "lon": lon, "lat": lat}
-    print('Transformed from:', wkt, 'to:', stations_wgs84[station])
 
 def create_str_field(layer, name, width=24):
+    from osgeo import ogr
+
     field_name = ogr.FieldDefn(name, ogr.OFTString)
     field_name.SetWidth(width)
     layer.CreateField(field_name)
@@ -443,6 +516,8 @@ def create_measuringstation_import_zip(file_path='asset_import_file', asset_name
         - INFRARED = 9
         - INCLINOMETER = 10""")
 
+    from osgeo import ogr
+
     filebase = file_path.replace('.shp', '').replace('.zip', '')\
         .replace('.ini', '')
 
@@ -454,7 +529,8 @@ def create_measuringstation_import_zip(file_path='asset_import_file', asset_name
                 print(filebase + extension + " not found.")
     driver = ogr.GetDriverByName('ESRI Shapefile')
     shapeData = driver.CreateDataSource(file_path + ".shp")
-    layer = shapeData.CreateLayer('layer1', target, ogr.wkbPoint)
+    layer = shapeData.CreateLayer('layer1', spatial_reference(TARGET_EPSG),
+                                  ogr.wkbPoint)
     field_code = ogr.FieldDefn("code", ogr.OFTString)
     field_code.SetWidth(24)
     layer.CreateField(field_code)
@@ -466,7 +542,7 @@ def create_measuringstation_import_zip(file_path='asset_import_file', asset_name
     layer.CreateField(field_station_type)
 
     layerDefinition = layer.GetLayerDefn()
-    for station, geometry in stations_wgs84.items():
+    for station, geometry in wgs84_stations().items():
         wkt = geometry["WKT"]
         if station in station_names.keys():
             point = ogr.CreateGeometryFromWkt(wkt)
@@ -498,15 +574,22 @@ def create_measuringstation_import_zip(file_path='asset_import_file', asset_name
         os.remove(filebase + extension)
 
 
-create_measuringstation_import_zip(asset_name="MeasuringStation", station_type=3, prefix="G4AW_MEKONG")
+CACHE_DIRECTORY = 'mrcmekong_cache'
+CACHE_SIZE = 2 ** 28
+CACHE_MAX_AGE = 30 * 24 * 3600
+
 
-def download(url):
-    request_obj = urllib.request.Request(url)
-    with urllib.request.urlopen(request_obj) as resp:
-        encoding = resp.headers.get_content_charset()
-        encoding = encoding if encoding else 'UTF-8'
-        content = resp.read().decode(encoding)
-        return content
+def http_cache(offline=False):
+    """The on disk cache for the Mekong pages. The historical pages hardly
+    ever change, so they are only revalidated after CACHE_MAX_AGE."""
+    return fetch.Cache(CACHE_DIRECTORY, CACHE_SIZE, CACHE_MAX_AGE, offline)
+
+
+def download(url, offline=False):
+    """Text of the page at url, from the cache when it is there. offline
+    only uses the cache."""
+    with fetch.Fetcher(1, cache=http_cache(offline)) as fetcher:
+        return fetcher.text(url)
 
 
 def make_csvwriter(filename):
@@ -518,10 +601,10 @@ def make_csvwriter(filename):
 
 
 def walk_element_text(element):
-    text = element.text.strip(' \r\n\t') if element.text else ''
-    for el in element.getchildren():
-        text += walk_element_text(el)
-    return text
+    """Text of element and its descendants without their tails, every
+    piece stripped of whitespace."""
+    return ''.join(el.text.strip(' \r\n\t') for el in element.iter()
+                   if el.text)
 
 day = datetime.timedelta(days=1)
 
@@ -533,143 +616,213 @@ def days_in_month(date):
     return (incremented_date - day).day
 
 
-def read_cols(tree, xpath_base, table, row_range, col_range, start_date, null=-999.0):
-    result = []
-    day = datetime.timedelta(days=1)
+NULL = -999.0
+
+# The tables on the pages of a season, by name, and the rows and columns
+# with a day per cell; the first day is in the top left, days run down the
+# columns.
+PAGES = {
+    "flood": {"tables": {"waterlevel": 6, "precipitation": 7},
+              "row_range": (3, 34), "col_range": (2, 7)},
+    "dry": {"tables": {"waterlevel": 6},
+            "row_range": (3, 34), "col_range": (2, 9)},
+}
+
+html_parser = etree.HTMLParser(remove_comments=True)
+find_table = etree.XPath('//*[@id=$id]')
+find_rows = etree.XPath('tr')
+find_cells = etree.XPath('td')
+find_font = etree.XPath('font[1]')
+
+
+def table_grid(table):
+    """
+    Text of the cells of a table element in one walk over its rows.
+    grid[row - 1][col - 1] holds what the xpath tr[{row}]/td[{col}]/font
+    gives with walk_element_text: the text of the first font in a td, ""
+    without one.
+    """
+    grid = []
+    for row in find_rows(table):
+        cells = []
+        for cell in find_cells(row):
+            font = find_font(cell)
+            cells.append(walk_element_text(font[0]) if font else "")
+        grid.append(cells)
+    return grid
+
+
+def read_table(tree, table):
+    """Grid of the element with id table{table}, see table_grid."""
+    tables = find_table(tree, id='table{}'.format(table))
+    return table_grid(tables[0]) if tables else []
+
+
+def grid_cells(grid, row_range, col_range, start_date):
+    """Yields (date, cell text) for the cells of the days in grid, a month
+    per column."""
     for col in range(*col_range):
         for row in range(*row_range):
             if row - row_range[0] >= days_in_month(start_date - day):
                 continue
-            xpath = xpath_base.format(row=row, col=col, table=table)
-            result = tree.xpath(xpath)
-            cell_content = walk_element_text(result[0]) if result else ""
-            try:
-                yield {
-                    "datetime": start_date,
-                    "value": float(cell_content),
-                    "flag": 0
-                }
-            except ValueError:
-                yield {
-                    "datetime": start_date,
-                    "value": null,
-                    "flag": 0
-                }
+            cells = grid[row - 1] if row <= len(grid) else []
+            yield start_date, cells[col - 1] if col <= len(cells) else ""
             start_date += day
 
 
-def create_timeseries_pixml():
+def cell_value(cell_content, null=NULL):
+    try:
+        return float(cell_content)
+    except ValueError:
+        return null
+
+
+def read_cols(tree, table, row_range, col_range, start_date, null=NULL):
+    for date, cell_content in grid_cells(read_table(tree, table), row_range,
+                                         col_range, start_date):
+        yield {
+            "datetime": date,
+            "value": cell_value(cell_content, null),
+            "flag": 0
+        }
+
+
+def read_page(html, season, start_date, null=NULL):
+    """
+    Parses a flood or dry season page once and reads all its tables in
+    PAGES. Comments are dropped by the parser, text around them is merged.
+
+    Returns:
+        {table name: series.Series} with a value per day from start_date,
+        null where a cell holds no number (series.Series.stats counts
+        those as missing).
+    """
+    page = PAGES[season]
+    tables = {}
+    for element in etree.HTML(html, html_parser).iter('table'):
+        tables.setdefault(element.get('id'), element)
+    result = {}
+    for name, table in page["tables"].items():
+        element = tables.get('table{}'.format(table))
+        grid = table_grid(element) if element is not None else []
+        values = series.Series(missing_value=null)
+        for date, cell_content in grid_cells(
+                grid, page["row_range"], page["col_range"], start_date):
+            values.append_datetime(date, cell_value(cell_content, null))
+        result[name] = values
+    return result
+
+
+def station_urls(station_name):
+    """The flood and dry season pages of a station in the order they are
+    read, as (season, url, start_date)."""
+    urls = []
+    for year in range(2008, 2016):
+        urls.append(("flood", waterlevels_flood.format(
+            year=year, station_name=stations[station_name][0]),
+            datetime.datetime(year=year, month=6, day=1)))
+    for years in ('2013_2014', '2014_2015', '2015_2016'):
+        if station_name in missing_dry:
+            continue
+        urls.append(("dry", waterlevels_dry.format(
+            year=years, station_name=stations[station_name][0]),
+            datetime.datetime(year=int(years.split('_')[0]), month=11, day=1)))
+    return urls
+
+
+def read_pages(fetcher, executor, pages, window=None):
+    """
+    Fetches pages, (season, url, start_date) tuples, with fetcher and parses
+    them with read_page in the processes of executor. Only the html goes to
+    a worker and only the Series of its tables come back. At most window
+    pages are being parsed at a time.
+
+    Yields:
+        the read_page result of every page, in the order of pages.
+    """
+    window = window or 2 * (os.cpu_count() or 1)
+    pending = collections.deque()
+    htmls = fetcher.map(url for _, url, _ in pages)
+    for html, (season, _, start_date) in zip(htmls, pages):
+        pending.append(executor.submit(read_page, html, season, start_date))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def create_timeseries_pixml(state=None, workers=8, offline=False,
+                            processes=None):
+    """
+    Scrapes the flood and dry season pages of all stations into a waterlevel
+    and a precipitation pixml. The pages of all stations are fetched by
+    workers threads over keep-alive connections and parsed by processes
+    worker processes, see read_pages; the results are read in station order
+    while later pages are still coming in. Pages come from the http_cache
+    when they can, with offline=True nothing is fetched at all.
+    """
     precipitation_headerdicts = {}
     waterlevel_headerdicts = {}
     precipitation_values = {}
     waterlevel_values = {}
-    for station_name, station_code in station_names.items():
-        if stations[station_name][0] is None:
-            continue
-        data_precipitation = []
-        data_waterlevel = []
-        code = 'G4AW_MEKONG_' + station_code
-        name_ = 'G4AW_MEKONG ' + station_name
-        geometry = stations_wgs84[station_name]
-        # waterlevels_name = 'G4AW_MEKONG_waterlevels_' + station_code
-        parameter_referenced_unit_waterlevels = "WNS2186"
-        # precipitation_name = 'G4AW_MEKONG_precipitation_' + station_code
-        parameter_referenced_unit_precipitation = "WNS1400"
-        print('loading station', station_name)
-        for year in range(2008, 2016):
-            flood_url = waterlevels_flood.format(
-                year=year, station_name=stations[station_name][0])
-            print('"flood" url:', flood_url)
-            flood_html = download(flood_url)
-            flood_html = re.sub("<!--[past_vlrin_send]+[0-9]+-->", "", flood_html)
-
-            flood_tree = etree.HTML(flood_html)
-            flood_xpath = '//*[@id="table{table}"]/tr[{row}]/td[{col}]/font'
-            start_date = datetime.datetime(year=year, month=6, day=1)
-            data_waterlevel += list(read_cols(
-                tree=flood_tree,
-                xpath_base=flood_xpath,
-                table=6,
-                row_range=(3, 34),
-                col_range=(2, 7),
-                start_date=start_date
-            ))
-            data_precipitation += list(read_cols(
-                tree=flood_tree,
-                xpath_base=flood_xpath,
-                table=7,
-                row_range=(3, 34),
-                col_range=(2, 7),
-                start_date=start_date
-            ))
-
-        for years in ('2013_2014', '2014_2015', '2015_2016'):
-            if station_name in missing_dry:
-                continue
-            dry_url = waterlevels_dry.format(
-                year=years, station_name=stations[station_name][0])
-            dry_html = download(dry_url)
-            dry_html = re.sub("<!--[past_vlrin_send]+[0-9]+-->", "", dry_html)
-
-            dry_tree = etree.HTML(dry_html)
-            dry_xpath = './/*[@id="table{table}"]/tr[{row}]/td[{col}]/font'
-            print('"dry" url:', dry_url)
-            start_date = datetime.datetime(
-                year=int(years.split('_')[0]),
-                month=11,
-                day=1
+    station_pages = [
+        (station_name, station_urls(station_name))
+        for station_name in station_names
+        if stations[station_name][0] is not None]
+    # The workers are started by a forkserver: forking this process while
+    # the fetcher's threads hold their locks can deadlock the children.
+    with fetch.Fetcher(workers, cache=http_cache(offline)) as fetcher, \
+            concurrent.futures.ProcessPoolExecutor(
+                processes, mp_context=multiprocessing.get_context(
+                    'forkserver')) as executor:
+        results = read_pages(fetcher, executor, [
+            page for _, urls in station_pages for page in urls])
+        for station_name, urls in station_pages:
+            data_precipitation = series.Series(missing_value=NULL)
+            data_waterlevel = series.Series(missing_value=NULL)
+            code = 'G4AW_MEKONG_' + station_names[station_name]
+            name_ = 'G4AW_MEKONG ' + station_name
+            geometry = wgs84_stations()[station_name]
+            # waterlevels_name = 'G4AW_MEKONG_waterlevels_' + station_code
+            parameter_referenced_unit_waterlevels = "WNS2186"
+            # precipitation_name = 'G4AW_MEKONG_precipitation_' + station_code
+            parameter_referenced_unit_precipitation = "WNS1400"
+            print('loading station', station_name)
+            for season, url, start_date in urls:
+                print('"{}" url:'.format(season), url)
+                tables = next(results)
+                data_waterlevel.extend(tables["waterlevel"])
+                if "precipitation" in tables:
+                    data_precipitation.extend(tables["precipitation"])
+            precipitation_values[code] = data_precipitation
+            waterlevel_values[code] = data_waterlevel
+            waterlevel_headerdicts[code] = lizard_scrapelib.pixml.header(
+                locationId=code,
+                parameterId=parameter_referenced_unit_waterlevels,
+                stationName=name_,
+                lat=geometry['lat'],
+                lon=geometry['lon'],
+                units="m"
+            )
+            precipitation_headerdicts[code] = lizard_scrapelib.pixml.header(
+                locationId=code,
+                parameterId=parameter_referenced_unit_precipitation,
+                stationName=name_,
+                lat=geometry['lat'],
+                lon=geometry['lon'],
+                units="mm"
             )
-            data_waterlevel += list(read_cols(
-                tree=dry_tree,
-                xpath_base=dry_xpath,
-                table=6,
-                row_range=(3, 34),
-                col_range=(2, 9),
-                start_date=start_date
-            ))
-        precipitation_values[code] = data_precipitation
-        waterlevel_values[code] = data_waterlevel
-        waterlevel_headerdicts[code] = lizard_scrapelib.pixml.header(
-            locationId=code,
-            parameterId=parameter_referenced_unit_waterlevels,
-            stationName=name_,
-            lat=geometry['lat'],
-            lon=geometry['lon'],
-            units="m"
-        )
-        precipitation_headerdicts[code] = lizard_scrapelib.pixml.header(
-            locationId=code,
-            parameterId=parameter_referenced_unit_precipitation,
-            stationName=name_,
-            lat=geometry['lat'],
-            lon=geometry['lon'],
-            units="mm"
-        )
     lizard_scrapelib.pixml.create(waterlevel_headerdicts, waterlevel_values,
-        filename="waterlevel_pixml_for_lizard.xml", timeZone=0.0)
+        filename="waterlevel_pixml_for_lizard.xml", timeZone=0.0, state=state)
     lizard_scrapelib.pixml.create(precipitation_headerdicts, precipitation_values,
-                 filename="precipitation_pixml_for_lizard.xml", timeZone=0.0)
+                 filename="precipitation_pixml_for_lizard.xml", timeZone=0.0,
+                 state=state)
 
 
 def create_timeseries_api(organisation):
-    timeseries_location = lizard_connector.connector._Endpoint(
-        base="http://integration.nxt.lizard.net",
-        endpoint="locations",
-        username=USR,
-        password=PWD
-    )
-    timeseries_waterlevel = lizard_connector.connector._Endpoint(
-        base="http://integration.nxt.lizard.net",
-        endpoint="timeseries",
-        username=USR,
-        password=PWD
-    )
-    timeseries_precipitation = lizard_connector.connector._Endpoint(
-        base="http://integration.nxt.lizard.net",
-        endpoint="timeseries",
-        username=USR,
-        password=PWD
-    )
+    timeseries_location = lizard_endpoint("locations")
+    timeseries_waterlevel = lizard_endpoint("timeseries")
+    timeseries_precipitation = lizard_endpoint("timeseries")
     timeseries_information = []
     locations_information = []
     for name, station in station_names.items():
@@ -679,7 +832,7 @@ def create_timeseries_api(organisation):
             "name": name_,
             "organisation": organisation,
             "organisation_code": code,
-            "geometry": stations_wgs84[name],
+            "geometry": wgs84_stations()[name],
             "access_modifier": 100,
         }
         print(location_data)
@@ -720,12 +873,7 @@ waterlevels_dry = "http://ffw.mrcmekong.org/historical_data_dry/" \
 
 
 def load_historical_mekong_data():
-    timeseries = lizard_connector.connector._Endpoint(
-        base="http://integration.nxt.lizard.net",
-        endpoint="timeseries",
-        username=USR,
-        password=PWD
-    )
+    timeseries = lizard_endpoint("timeseries")
 
     timeseries_results = []
 
@@ -745,17 +893,14 @@ def load_historical_mekong_data():
             flood_html = re.sub("<!--[past_vlrin_send]+[0-9]+-->", "", flood_html)
 
             flood_tree = etree.HTML(flood_html)
-            flood_xpath = '//*[@id="table{table}"]/tr[{row}]/td[{col}]/font'
             data_waterlevel = list(read_cols(
                 tree=flood_tree,
-                xpath_base=flood_xpath,
                 table=6,
                 row_range=(3, 34),
                 col_range=(2, 7)
             ))
             data_precipitation = list(read_cols(
                 tree=flood_tree,
-                xpath_base=flood_xpath,
                 table=7,
                 row_range=(3, 34),
                 col_range=(2, 7)
@@ -777,12 +922,10 @@ def load_historical_mekong_data():
             dry_html = re.sub("<!--[past_vlrin_send]+[0-9]+-->", "", dry_html)
 
             dry_tree = etree.HTML(dry_html)
-            dry_xpath = './/*[@id="table{table}"]/tr[{row}]/td[{col}]/font'
             print('"dry" url:', dry_url)
 
             data_waterlevel = list(read_cols(
                 tree=dry_tree,
-                xpath_base=dry_xpath,
                 table=6,
                 row_range=(3, 34),
                 col_range=(2, 9)
@@ -843,6 +986,7 @@ def load_historical_mekong_data():
 
 
 if __name__ == "__main__":
+    create_measuringstation_import_zip(asset_name="MeasuringStation", station_type=3, prefix="G4AW_MEKONG")
     create_timeseries_pixml()
     pass
     # create_timeseries(organisation=G4AW_VIETNAM_ORGANISATION)
@@ -1,13 +1,35 @@
+import array
+import collections.abc
+import concurrent.futures
+import contextlib
+import csv
 import datetime
 import ftplib
 import gzip
+import io
+import itertools
+import json
 import os
+import pickle
+import queue
+import shutil
+import time
+
+# numpy is only needed by the numpy parser, import_numpy loads it then.
+numpy = None
 
 try:
     import pixml
+    import series
+    import store
 except ImportError:
     from lizard_scrapelib import pixml
+    from lizard_scrapelib import series
+    from lizard_scrapelib import store
 
+FTP_HOST = 'ftp.ncdc.noaa.gov'
+FTP_DIRECTORY = '/pub/data/ghcn/daily/by_year/'
+FTP_BLOCK_SIZE = 2 ** 18
 FIRST_YEAR = 1763
 ELEMENT_TYPES = ("TMAX", "TMIN", "TAVG", "PRCP", "SNWD", "SNOW", "EVAP")
 ELEMENT_TYPE_UNITS = {
@@ -21,95 +43,610 @@ ELEMENT_TYPE_UNITS = {
 }
 
 
-def ungzip(filename, remove=False, encoding='utf-8'):
-    zipped = gzip.GzipFile(filename=filename, mode='rb')
+BUFFER_SIZE = 2 ** 20
+
+
+def ungzip(filename, remove=False):
     new_filename = filename.replace('.gz', '')
-    with open(new_filename, 'w') as new_file:
-        new_file.write(zipped.read().decode(encoding))
+    with gzip.GzipFile(filename=filename, mode='rb') as zipped, \
+            open(new_filename, 'wb') as new_file:
+        shutil.copyfileobj(zipped, new_file, BUFFER_SIZE)
     if remove:
         os.remove(filename)
     return new_filename
 
 
-def grab_files(data_dir="data", first_year=FIRST_YEAR, last_year=None):
+def open_data_file(filepath, encoding='utf-8', buffer_size=BUFFER_SIZE):
+    """
+    Opens a by_year file for reading text. A .gz file is decompressed while
+    it is read, through a buffer of buffer_size bytes, instead of being
+    unzipped to disk first.
+    """
+    if filepath.endswith('.gz'):
+        zipped = io.BufferedReader(
+            gzip.GzipFile(filename=filepath, mode='rb'), buffer_size)
+        return io.TextIOWrapper(zipped, encoding=encoding)
+    return open(filepath, 'r', encoding=encoding, buffering=buffer_size)
+
+
+class FTPPool(object):
+    """
+    A small pool of logged in FTP sessions that are reused between
+    transfers. A session that fails is closed instead of returned to the
+    pool.
+    """
+
+    def __init__(self, host=FTP_HOST, directory=FTP_DIRECTORY, port=21,
+                 user='', passwd='', timeout=60):
+        self.host = host
+        self.directory = directory
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+
+    def connect(self):
+        ftp = ftplib.FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.user, self.passwd)
+        ftp.cwd(self.directory)
+        ftp.voidcmd('TYPE I')
+        return ftp
+
+    @contextlib.contextmanager
+    def session(self):
+        try:
+            ftp = self.idle.get_nowait()
+        except queue.Empty:
+            ftp = self.connect()
+        try:
+            yield ftp
+        except Exception:
+            ftp.close()
+            raise
+        self.idle.put(ftp)
+
+    def close(self):
+        while True:
+            try:
+                ftp = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def download_file(ftp_pool, filename, data_dir="data",
+                  block_size=FTP_BLOCK_SIZE, retries=3):
+    """
+    Downloads filename into data_dir over a session from ftp_pool. Data is
+    written to a .part file first; an interrupted transfer resumes from
+    the end of that file with a REST offset. A complete file of the remote
+    size is not downloaded again.
+    """
+    file_path = os.path.join(data_dir, filename)
+    part_path = file_path + '.part'
+    for attempt in range(retries + 1):
+        try:
+            with ftp_pool.session() as ftp:
+                size = ftp.size(filename)
+                if os.path.exists(file_path) and \
+                        os.path.getsize(file_path) == size:
+                    return file_path
+                offset = os.path.getsize(part_path) if os.path.exists(
+                    part_path) else 0
+                if offset > size:
+                    offset = 0
+                print('downloading', filename, 'from byte', offset)
+                with open(part_path, 'ab' if offset else 'wb') as localfile:
+                    ftp.retrbinary('RETR ' + filename, localfile.write,
+                                   block_size, rest=offset or None)
+            os.replace(part_path, file_path)
+            return file_path
+        except ftplib.all_errors as error:
+            if attempt == retries:
+                raise
+            print('retrying', filename, 'after', repr(error))
+
+
+def remote_stat(ftp_pool, filename):
+    """Size and modification time (MDTM) of a remote file."""
+    with ftp_pool.session() as ftp:
+        size = ftp.size(filename)
+        modified = ftp.voidcmd('MDTM ' + filename)[4:].strip()
+    return {"size": size, "modified": modified}
+
+
+def manifest_path(data_dir):
+    return os.path.normpath(data_dir) + '.manifest.json'
+
+
+def read_manifest(data_dir):
+    """
+    The manifest next to data_dir: {filename: {size, modified, complete}}
+    with the remote state of every file downloaded into data_dir.
+    """
+    try:
+        with open(manifest_path(data_dir), 'r') as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(data_dir, manifest):
+    path = manifest_path(data_dir)
+    with open(path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def changed_files(manifest, data_dir, stats):
+    """
+    Filenames whose remote stat differs from the manifest, that did not
+    finish downloading or that are missing locally. Local copies of files
+    that changed remotely are removed, .part files of unfinished downloads
+    of the same remote version are kept to resume from.
+    """
+    changed = []
+    for filename, stat in stats.items():
+        entry = manifest.get(filename, {})
+        file_path = os.path.join(data_dir, filename)
+        if entry.get("size") != stat["size"] or \
+                entry.get("modified") != stat["modified"]:
+            for path in (file_path, file_path + '.part'):
+                if os.path.exists(path):
+                    os.remove(path)
+        elif entry.get("complete") and os.path.exists(file_path):
+            continue
+        manifest[filename] = dict(stat, complete=False)
+        changed.append(filename)
+    return changed
+
+
+def grab_files(data_dir="data", first_year=FIRST_YEAR, last_year=None,
+               workers=4, block_size=FTP_BLOCK_SIZE, incremental=False,
+               **ftp_kwargs):
+    """
+    Downloads the by_year files with workers concurrent transfers over a
+    pool of reused FTP sessions and returns their paths in year order.
+    ftp_kwargs are passed to FTPPool, e.g. to use another host and port.
+
+    With incremental=True the remote SIZE and MDTM of every year are
+    compared to the manifest next to data_dir and only the years that
+    changed since the last run are downloaded and returned.
+    """
     if not last_year:
         last_year = datetime.datetime.now().year
-    filenames = (str(year) + "csv.gz" for year in range(
-        first_year, last_year + 1))
+    filenames = [str(year) + ".csv.gz" for year in range(
+        first_year, last_year + 1)]
+    os.makedirs(data_dir, exist_ok=True)
+    with FTPPool(**ftp_kwargs) as ftp_pool, \
+            concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        if not incremental:
+            return list(executor.map(
+                lambda filename: download_file(
+                    ftp_pool, filename, data_dir, block_size),
+                filenames))
 
-    # connect to domain name:
-    ftp = ftplib.FTP('ftp.ncdc.noaa.gov/')
-    ftp.login()
+        manifest = read_manifest(data_dir)
+        stats = dict(zip(filenames, executor.map(
+            lambda filename: remote_stat(ftp_pool, filename), filenames)))
+        filenames = changed_files(manifest, data_dir, stats)
+        print(len(filenames), 'of', len(stats), 'files changed')
+        write_manifest(data_dir, manifest)
 
-    # change to relevant folder
-    ftp.cwd('/pub/data/ghcn/daily/by_year/')
+        def download(filename):
+            file_path = download_file(
+                ftp_pool, filename, data_dir, block_size)
+            manifest[filename]["complete"] = True
+            return file_path
 
-    # iterate over filenames
-    for filename in filenames:
-        file_path = os.path.join(data_dir, filename)
-        with open(file_path, 'wb') as localfile:
-            ftp.retrbinary('RETR ' + filename, localfile.write, 1024)
-        file_path = ungzip(file_path, remove=True)
-    ftp.quit()
-
-
-def read_file(element_type, filepath):
-    flag_codes = {
-        "": 0, "D": 1, "G": 2, "I": 3, "K": 4, "L": 5, "M": 6, "N": 7, "O": 8,
-        "R": 9, "S": 10, "T": 11, "W": 12, "X": 13, "Z": 14
-    }
-    values_all_stations = {}
-    print("reading", filepath, element_type)
-    with open(filepath, 'r') as current_file:
-        for line in current_file:
-            line = line.strip('\n').split(',')
-            # [0] ID = 11 character station identification code
-            # [1] YEAR/MONTH/DAY = 8 character date in YYYYMMDD format
-            #     (e.g. 19860529 = May 29, 1986)
-            # [2] ELEMENT = 4 character indicator of element type
-            # [3] DATA VALUE = 5 character data value for ELEMENT
-            # [4] M-FLAG = 1 character Measurement Flag
-            # [5] Q-FLAG = 1 character Quality Flag
-            # [6] S-FLAG = 1 character Source Flag
-            # [7] OBS-TIME = 4-character time of observation in hour-minute
-            #     format (i.e. 0700 =7:00 am)
-            #
-            # Q-FLAG CODES:
-            # [0] Blank = did not fail any quality assurance check
-            # [1]   D   = failed duplicate check
-            # [2]   G   = failed gap check
-            # [3]   I   = failed internal consistency check
-            # [4]   K   = failed streak/frequent-value check
-            # [5]   L   = failed check on length of multiday period
-            # [6]   M   = failed megaconsistency check
-            # [7]   N   = failed naught check
-            # [8]   O   = failed climatological outlier check
-            # [9]   R   = failed lagged range check
-            # [10]  S   = failed spatial consistency check
-            # [11]  T   = failed temporal consistency check
-            # [12]  W   = temperature too warm for snow
-            # [13]  X   = failed bounds check
-            # [14]  Z   = flagged as a result of an official Datzilla
-            #             investigation
+        try:
+            return list(executor.map(download, filenames))
+        finally:
+            write_manifest(data_dir, manifest)
 
-            try:
-                date_time = datetime.datetime.strptime(
-                    line[1] + line[7], "%Y%m%d%H%M")
-            except ValueError:
-                date_time = datetime.datetime.strptime(line[1], "%Y%m%d")
-            if line[2] == element_type:
-                values = values_all_stations.get(line[0], [])
-                values.append({
-                    "datetime": date_time,
-                    "value": line[3],
-                    "flag": flag_codes[line[5]]
-                })
-                values_all_stations[line[0]] = values
-        return values_all_stations
 
+FLAG_CODES = {
+    "": 0, "D": 1, "G": 2, "I": 3, "K": 4, "L": 5, "M": 6, "N": 7, "O": 8,
+    "R": 9, "S": 10, "T": 11, "W": 12, "X": 13, "Z": 14
+}
+EPOCH_DATE = datetime.date(1970, 1, 1)
+BLOCK_SIZE = 2 ** 25
 
-def parse_headers(elem_type, param_units,
-                  ghcnd_stations_filepath='ghcnd-stations.txt'):
+
+def date_timestamp(date):
+    """Epoch seconds for a YYYYMMDD string."""
+    days = (datetime.date(int(date[:4]), int(date[4:6]), int(date[6:8])) -
+            EPOCH_DATE).days
+    return days * 86400
+
+
+def obs_time_seconds(obs_time):
+    """Seconds since midnight for a HHMM OBS-TIME, 0 when blank or invalid."""
+    if len(obs_time) != 4 or not obs_time.isdigit():
+        return 0
+    hours, minutes = int(obs_time[:2]), int(obs_time[2:])
+    if hours > 23 or minutes > 59:
+        return 0
+    return hours * 3600 + minutes * 60
+
+
+def date_string(date):
+    if date is None or isinstance(date, str):
+        return date
+    return '{:04d}{:02d}{:02d}'.format(date.year, date.month, date.day)
+
+
+class Filters(object):
+    """
+    Row filters the parsers apply while they scan a year file, before any
+    object is created for a row.
+
+    Args:
+        prefixes(iterable): station ID prefixes to keep, e.g. country codes
+            like "US" or "ASN".
+        bbox(tuple): (min_lon, min_lat, max_lon, max_lat) to keep stations
+            in, needs station_index.
+        start(date or str): first day to keep, a date or YYYYMMDD.
+        end(date or str): last day to keep, a date or YYYYMMDD.
+        exclude_qflags(iterable): Q-FLAG codes of rows to drop, e.g. "DX".
+        station_index(StationIndex): see read_station_index.
+    """
+
+    def __init__(self, prefixes=None, bbox=None, start=None, end=None,
+                 exclude_qflags=(), station_index=None):
+        if bbox is not None and station_index is None:
+            raise TypeError("A bbox filter needs a station_index")
+        self.prefixes = tuple(prefixes) if prefixes is not None else None
+        self.bbox = bbox
+        self.start = date_string(start)
+        self.end = date_string(end)
+        self.exclude_qflags = frozenset(exclude_qflags)
+        self.station_index = station_index
+        self.stations = {}
+
+    @property
+    def filters_stations(self):
+        return self.prefixes is not None or self.bbox is not None
+
+    def keep_station(self, station_id):
+        keep = self.stations.get(station_id)
+        if keep is None:
+            keep = self.stations[station_id] = self._keep_station(station_id)
+        return keep
+
+    def _keep_station(self, station_id):
+        if self.prefixes is not None and not station_id.startswith(
+                self.prefixes):
+            return False
+        if self.bbox is not None:
+            if station_id not in self.station_index:
+                return False
+            lat, lon, _ = self.station_index[station_id]
+            min_lon, min_lat, max_lon, max_lat = self.bbox
+            return min_lon <= lon <= max_lon and min_lat <= lat <= max_lat
+        return True
+
+    def keep_row(self, date, qflag):
+        return not (
+            (self.start is not None and date < self.start) or
+            (self.end is not None and date > self.end) or
+            qflag in self.exclude_qflags)
+
+    def mask(self, station_ids, dates, qflags):
+        """Boolean mask of rows to keep for the numpy parser."""
+        keep = numpy.ones(len(dates), dtype=bool)
+        if self.start is not None:
+            keep &= dates >= int(self.start)
+        if self.end is not None:
+            keep &= dates <= int(self.end)
+        if self.exclude_qflags:
+            keep &= ~numpy.isin(
+                qflags, [ord(qflag) if qflag else 0
+                         for qflag in self.exclude_qflags])
+        if self.filters_stations:
+            unique_ids, inverse = numpy.unique(
+                station_ids, return_inverse=True)
+            keep &= numpy.array([
+                self.keep_station(station_id.decode('ascii'))
+                for station_id in unique_ids], dtype=bool)[inverse]
+        return keep
+
+
+def parse_lines_python(lines, buckets, filters=None):
+    """
+    Pure Python parser. Dates and observation times are converted with
+    integer slicing and cached, a year file only holds 366 distinct dates.
+    Stations rejected by filters are skipped before a row is split.
+    """
+    timestamps = {}
+    seconds = {"": 0}
+    flag_codes = FLAG_CODES
+    keep_station = None
+    keep_row = None
+    if filters is not None:
+        if filters.filters_stations:
+            keep_station = filters.keep_station
+        keep_row = filters.keep_row
+    for line in lines:
+        if keep_station is not None and not keep_station(line[:11]):
+            continue
+        line = line.strip('\n').split(',')
+        # [0] ID = 11 character station identification code
+        # [1] YEAR/MONTH/DAY = 8 character date in YYYYMMDD format
+        #     (e.g. 19860529 = May 29, 1986)
+        # [2] ELEMENT = 4 character indicator of element type
+        # [3] DATA VALUE = 5 character data value for ELEMENT
+        # [4] M-FLAG = 1 character Measurement Flag
+        # [5] Q-FLAG = 1 character Quality Flag
+        # [6] S-FLAG = 1 character Source Flag
+        # [7] OBS-TIME = 4-character time of observation in hour-minute
+        #     format (i.e. 0700 =7:00 am)
+        #
+        # Q-FLAG CODES:
+        # [0] Blank = did not fail any quality assurance check
+        # [1]   D   = failed duplicate check
+        # [2]   G   = failed gap check
+        # [3]   I   = failed internal consistency check
+        # [4]   K   = failed streak/frequent-value check
+        # [5]   L   = failed check on length of multiday period
+        # [6]   M   = failed megaconsistency check
+        # [7]   N   = failed naught check
+        # [8]   O   = failed climatological outlier check
+        # [9]   R   = failed lagged range check
+        # [10]  S   = failed spatial consistency check
+        # [11]  T   = failed temporal consistency check
+        # [12]  W   = temperature too warm for snow
+        # [13]  X   = failed bounds check
+        # [14]  Z   = flagged as a result of an official Datzilla
+        #             investigation
+        values_all_stations = buckets.get(line[2])
+        if values_all_stations is None:
+            continue
+        if keep_row is not None and not keep_row(line[1], line[5]):
+            continue
+        timestamp = timestamps.get(line[1])
+        if timestamp is None:
+            timestamp = timestamps[line[1]] = date_timestamp(line[1])
+        obs_seconds = seconds.get(line[7])
+        if obs_seconds is None:
+            obs_seconds = seconds[line[7]] = obs_time_seconds(line[7])
+        values = values_all_stations.get(line[0])
+        if values is None:
+            values = values_all_stations[line[0]] = series.Series()
+        values.append(timestamp + obs_seconds, float(line[3]),
+                      flag_codes[line[5]])
+
+
+def read_blocks(current_file, block_size):
+    """Yields blocks of whole lines of about block_size characters."""
+    rest = ''
+    while True:
+        block = current_file.read(block_size)
+        if not block:
+            break
+        block = rest + block
+        end = block.rfind('\n') + 1
+        rest = block[end:]
+        if end:
+            yield block[:end]
+    if rest:
+        yield rest + '\n'
+
+
+def import_numpy():
+    """numpy, imported on first use so that importing noaa stays cheap, or
+    None when it is not installed."""
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as numpy_module
+        except ImportError:
+            return None
+        numpy = numpy_module
+    return numpy
+
+
+def parse_digits(buffer, starts, ends, width):
+    """
+    Integers from the digits between starts and ends, fields hold at most
+    width characters.
+    """
+    positions = ends[:, None] - width + numpy.arange(width)
+    digits = buffer[positions] - numpy.uint8(48)
+    digits[(digits > 9) | (positions < starts[:, None])] = 0
+    powers = 10 ** numpy.arange(width - 1, -1, -1, dtype=numpy.int64)
+    return digits.astype(numpy.int64) @ powers
+
+
+def parse_lines_numpy(lines, buckets, filters=None, block_size=BLOCK_SIZE):
+    """
+    NumPy parser. Reads blocks of block_size characters and converts the
+    columns of all rows in a block at once, straight from the bytes.
+    Relies on the fixed widths of the ID, date and element fields and
+    integer data values, as documented for the by_year files.
+    """
+    if import_numpy() is None:
+        raise ImportError("The numpy parser needs numpy to be installed")
+    element_codes = {
+        numpy.frombuffer(element_type.encode('ascii'), dtype='S4')[0]:
+            element_type for element_type in buckets}
+    element_types = numpy.array(sorted(element_codes))
+    flag_codes = numpy.zeros(256, dtype=numpy.uint8)
+    for code, number in FLAG_CODES.items():
+        flag_codes[ord(code) if code else 0] = number
+    for block in read_blocks(lines, block_size):
+        buffer = numpy.frombuffer(block.encode('ascii'), dtype=numpy.uint8)
+        # Every row has 8 fields: 7 comma's and a newline.
+        delimiters = numpy.flatnonzero(
+            (buffer == 44) | (buffer == 10)).reshape(-1, 8)
+        starts = numpy.empty(len(delimiters), dtype=numpy.int64)
+        starts[0] = 0
+        starts[1:] = delimiters[:-1, 7] + 1
+        elements = buffer[starts[:, None] + numpy.arange(21, 25)].view(
+            'S4')[:, 0]
+        keep = numpy.isin(elements, element_types)
+        if not keep.any():
+            continue
+        delimiters, starts, elements = (
+            delimiters[keep], starts[keep], elements[keep])
+        station_ids = buffer[starts[:, None] + numpy.arange(11)].view(
+            'S11')[:, 0]
+        dates = parse_digits(buffer, starts + 12, starts + 20, 8)
+        qflags = numpy.where(
+            delimiters[:, 5] - delimiters[:, 4] == 2,
+            buffer[delimiters[:, 4] + 1], 0)
+        if filters is not None:
+            keep = filters.mask(station_ids, dates, qflags)
+            if not keep.any():
+                continue
+            delimiters, starts, elements, station_ids, dates, qflags = (
+                delimiters[keep], starts[keep], elements[keep],
+                station_ids[keep], dates[keep], qflags[keep])
+
+        days = (
+            (dates // 10000 - 1970).astype('datetime64[Y]')
+            .astype('datetime64[M]') + (dates // 100 % 100 - 1)
+        ).astype('datetime64[D]') + (dates % 100 - 1)
+        timestamps = days.astype(numpy.int64) * 86400
+        obs_times = parse_digits(
+            buffer, delimiters[:, 6] + 1, delimiters[:, 7], 4)
+        hours, minutes = obs_times // 100, obs_times % 100
+        valid = ((delimiters[:, 7] - delimiters[:, 6] == 5) &
+                 (hours < 24) & (minutes < 60))
+        for offset in range(1, 5):
+            valid &= buffer[delimiters[:, 7] - offset] - numpy.uint8(48) < 10
+        timestamps += numpy.where(valid, hours * 3600 + minutes * 60, 0)
+
+        values = parse_digits(
+            buffer, delimiters[:, 2] + 1, delimiters[:, 3], 6)
+        # Negated as floats, so "-0" gives -0.0 like float("-0") does.
+        values = values.astype(numpy.float32)
+        values = numpy.where(
+            buffer[delimiters[:, 2] + 1] == 45, -values, values)
+        flags = flag_codes[qflags]
+
+        element_index = numpy.searchsorted(element_types, elements)
+        station_ids, station_index = numpy.unique(
+            station_ids, return_inverse=True)
+        keys = element_index * len(station_ids) + station_index
+        order = numpy.argsort(keys, kind='stable')
+        keys = keys[order]
+        timestamps = timestamps[order]
+        values = values[order]
+        flags = flags[order]
+        bounds = numpy.flatnonzero(keys[1:] != keys[:-1]) + 1
+        for start, end in zip([0] + list(bounds), list(bounds) + [len(keys)]):
+            element_type = element_codes[element_types[element_index[
+                order[start]]]]
+            station_id = station_ids[station_index[order[start]]].decode(
+                'ascii')
+            values_all_stations = buckets[element_type]
+            station_values = values_all_stations.get(station_id)
+            if station_values is None:
+                station_values = values_all_stations[station_id] = \
+                    series.Series()
+            station_values.frombytes(timestamps[start:end].tobytes(),
+                                     values[start:end].tobytes(),
+                                     flags[start:end].tobytes())
+
+
+PARSERS = {
+    "python": parse_lines_python,
+    "numpy": parse_lines_numpy
+}
+
+
+def read_file_elements(filepath, element_types=ELEMENT_TYPES,
+                       parser="python", filters=None):
+    """
+    Reads a GHCN by_year csv once and sorts every row into a bucket per
+    element type.
+
+    Args:
+        filepath(str): path to the by_year csv, or the .csv.gz as
+            downloaded.
+        element_types(iterable): element types to keep, other rows are
+            skipped without parsing their date.
+        parser(str): one of PARSERS, "python" or "numpy".
+        filters(Filters): optional station, date and Q-flag filters that are
+            applied during the scan.
+
+    Returns:
+        {element_type: {station_id: series.Series}}
+    """
+    buckets = {element_type: {} for element_type in element_types}
+    print("reading", filepath, ', '.join(buckets))
+    with open_data_file(filepath) as current_file:
+        PARSERS[parser](current_file, buckets, filters)
+    return buckets
+
+
+def read_file(element_type, filepath, parser="python", filters=None):
+    return read_file_elements(filepath, (element_type, ), parser, filters)[
+        element_type]
+
+
+def benchmark_parsers(filepath, element_types=ELEMENT_TYPES, parsers=None):
+    """Prints and returns the rows per second each parser reaches."""
+    with open_data_file(filepath) as current_file:
+        row_count = sum(1 for _ in current_file)
+    results = {}
+    for parser in parsers or PARSERS:
+        if parser == "numpy" and import_numpy() is None:
+            print(parser, "skipped, numpy is not installed")
+            continue
+        start = time.perf_counter()
+        read_file_elements(filepath, element_types, parser)
+        results[parser] = row_count / (time.perf_counter() - start)
+        print("{}: {:.0f} rows/s".format(parser, results[parser]))
+    return results
+
+
+class StationIndex(object):
+    """
+    Compact table of the stations in ghcnd-stations.txt: a dict from station
+    ID to row and array columns for latitude and longitude.
+    """
+
+    def __init__(self, rows=None, lats=(), lons=(), names=()):
+        self.rows = rows or {}
+        self.lats = array.array('d', lats)
+        self.lons = array.array('d', lons)
+        self.names = list(names)
+
+    def columns(self):
+        return self.rows, self.lats, self.lons, self.names
+
+    def add(self, station_id, lat, lon, name):
+        self.rows[station_id] = len(self.lats)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.names.append(name)
+
+    def __getitem__(self, station_id):
+        """(lat, lon, name) of a station."""
+        row = self.rows[station_id]
+        return self.lats[row], self.lons[row], self.names[row]
+
+    def __contains__(self, station_id):
+        return station_id in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def parse_stations(ghcnd_stations_filepath='ghcnd-stations.txt'):
     # ID            1-11   Character
     # LATITUDE     13-20   Real
     # LONGITUDE    22-30   Real
@@ -119,44 +656,273 @@ def parse_headers(elem_type, param_units,
     # GSN FLAG     73-75   Character
     # HCN/CRN FLAG 77-79   Character
     # WMO ID       81-85   Character
-    headers = {}
-    print('parsing headers', elem_type)
+    index = StationIndex()
+    print('parsing stations', ghcnd_stations_filepath)
     with open(ghcnd_stations_filepath, 'r') as stations_txt:
         for line in stations_txt:
-            id = line[:11].strip(' ')
-            lat = float(line[13:20])
-            lon = float(line[22:30])
-            name = line[42:71].strip(' ')
-            headers[id] = pixml.header(
-                locationId="NOAA_" + id + "_" + elem_type,
-                parameterId=param_units['parameterId'],
-                stationName="NOAA_" + id,
-                lat=lat,
-                lon=lon,
-                units=param_units['units'])
-    return headers
+            index.add(line[:11].strip(' '), float(line[12:20]),
+                      float(line[21:30]), line[41:71].strip(' '))
+    return index
+
+
+_station_indexes = {}
+
+
+def read_station_index(ghcnd_stations_filepath='ghcnd-stations.txt'):
+    """
+    StationIndex for ghcnd-stations.txt. The parsed index is pickled next
+    to the file and kept in memory, both are reused until the mtime or size
+    of the file changes.
+    """
+    stat = os.stat(ghcnd_stations_filepath)
+    key = (stat.st_mtime, stat.st_size)
+    cached = _station_indexes.get(ghcnd_stations_filepath)
+    if cached and cached[0] == key:
+        return cached[1]
+    cache_path = ghcnd_stations_filepath + '.p'
+    index = None
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cache_key, columns = pickle.load(cache_file)
+        if cache_key == key:
+            index = StationIndex(*columns)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    if index is None:
+        index = parse_stations(ghcnd_stations_filepath)
+        with open(cache_path + '.tmp', 'wb') as cache_file:
+            pickle.dump((key, index.columns()), cache_file,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_path + '.tmp', cache_path)
+    _station_indexes[ghcnd_stations_filepath] = (key, index)
+    return index
+
+
+class StationHeaders(collections.abc.Mapping):
+    """
+    Mapping from station ID to the pixml header for one element type. A
+    header is only created when it is looked up, so only for the stations
+    that have values.
+    """
+
+    def __init__(self, station_index, elem_type, param_units):
+        self.station_index = station_index
+        self.elem_type = elem_type
+        self.param_units = param_units
+
+    def __getitem__(self, station_id):
+        lat, lon, _ = self.station_index[station_id]
+        return pixml.header(
+            locationId="NOAA_" + station_id + "_" + self.elem_type,
+            parameterId=self.param_units['parameterId'],
+            stationName="NOAA_" + station_id,
+            lat=lat,
+            lon=lon,
+            units=self.param_units['units'])
+
+    def __iter__(self):
+        return iter(self.station_index.rows)
+
+    def __len__(self):
+        return len(self.station_index)
+
+
+def parse_headers(elem_type, param_units,
+                  ghcnd_stations_filepath='ghcnd-stations.txt'):
+    return StationHeaders(read_station_index(ghcnd_stations_filepath),
+                          elem_type, param_units)
+
+
+def process_year(filepath, element_types=ELEMENT_TYPES, parser="python",
+                 filters=None):
+    """
+    Handles one year file end to end: streams it from the .gz and parses it
+    into Series per element type and station. Runs in the worker processes
+    of process_years.
+    """
+    return read_file_elements(filepath, element_types, parser, filters)
+
+
+def merge_values(values_per_element, other):
+    """Appends the Series in other to the ones in values_per_element."""
+    for element_type, values_all_stations in other.items():
+        merged = values_per_element.setdefault(element_type, {})
+        for station_id, values in values_all_stations.items():
+            if station_id in merged:
+                merged[station_id].extend(values)
+            else:
+                merged[station_id] = values
+    return values_per_element
+
+
+def process_years(filepaths, element_types=ELEMENT_TYPES, workers=None,
+                  parser="python", filters=None):
+    """
+    Processes year files in a pool of worker processes, one year file per
+    worker, and merges the results per element type and station.
+
+    Args:
+        filepaths(iterable): year files (.csv or .csv.gz) in year order.
+        workers(int): number of processes, defaults to the number of cpus.
+            With 1 the files are processed in this process.
+
+    Returns:
+        {element_type: {station_id: series.Series}}, each Series in time
+        order when filepaths are in year order.
+    """
+    values_per_element = {element_type: {} for element_type in element_types}
+    filepaths = list(filepaths)
+    if workers == 1:
+        for filepath in filepaths:
+            merge_values(values_per_element, process_year(
+                filepath, element_types, parser, filters))
+        return values_per_element
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        # map keeps the year order, so merged Series stay sorted in time.
+        for year_values in executor.map(
+                process_year, filepaths, itertools.repeat(element_types),
+                itertools.repeat(parser), itertools.repeat(filters)):
+            merge_values(values_per_element, year_values)
+    return values_per_element
+
+
+def year_store_path(store_dir, filepath):
+    return os.path.join(store_dir, os.path.basename(filepath).split('.')[0])
+
+
+def store_year(filepath, store_dir, element_types=ELEMENT_TYPES,
+               parser="python", filters=None):
+    """
+    Parses one year file into a store at store_dir/<year> and returns that
+    path. Runs in the worker processes of store_years.
+    """
+    path = year_store_path(store_dir, filepath)
+    store.write_store(
+        path, read_file_elements(filepath, element_types, parser, filters))
+    return path
+
+
+def store_years(filepaths, store_dir, element_types=ELEMENT_TYPES,
+                workers=None, parser="python", filters=None):
+    """
+    Parses every year file once into a binary store per year, in a pool of
+    worker processes, and returns the store paths in the order of
+    filepaths. Outputs can then be regenerated from the stores with
+    store_to_pixml without parsing the csv files again.
+    """
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(
+            store_year, filepaths, itertools.repeat(store_dir),
+            itertools.repeat(element_types), itertools.repeat(parser),
+            itertools.repeat(filters)))
 
 
 def read_files(element_types=ELEMENT_TYPES, data_dir="data",
-               first_year=FIRST_YEAR, last_year=None):
-    filepaths = iter(grab_files(data_dir, first_year, last_year))
-    for filepath in filepaths:
-        for element_type in element_types:
-            for value in read_file(element_type, filepath):
-                pass
-        os.remove(filepath)
+               first_year=FIRST_YEAR, last_year=None, workers=None,
+               parser="python", incremental=False, filters=None):
+    filepaths = grab_files(data_dir, first_year, last_year,
+                           incremental=incremental)
+    return process_years(filepaths, element_types, workers, parser, filters)
 
 
-def to_pixml(file_path_source, file_path_target, element_types=ELEMENT_TYPES,
-             element_type_units=ELEMENT_TYPE_UNITS):
+def write_pixml(values_per_element, file_path_target,
+                element_types=ELEMENT_TYPES,
+                element_type_units=ELEMENT_TYPE_UNITS, **create_kwargs):
+    """
+    Writes a pixml per element type, create_kwargs (e.g. max_series or
+    max_bytes to shard the output) are passed to pixml.create.
+    """
     for element_type in element_types:
         print('Creating pixml for', element_type)
-        values = read_file(element_type, file_path_source)
+        values = values_per_element.pop(element_type)
         headerdicts = parse_headers(element_type,
                                     element_type_units[element_type])
         pixml.create(headerdicts, values,
                      filename=file_path_target + element_type + ".xml",
-                     timeZone=0.0)
+                     timeZone=0.0, **create_kwargs)
+
+
+def write_stats(values_per_element, filename):
+    """
+    Writes a csv with the summary statistics of every station series for
+    QA, without scanning the events again for series that already know them.
+    """
+    with open(filename, 'w', newline='') as f:
+        csvwriter = csv.writer(f)
+        csvwriter.writerow(('element', 'station') + series.Stats._fields)
+        for element_type, values in sorted(values_per_element.items()):
+            for station_id in sorted(values):
+                csvwriter.writerow((element_type, station_id) +
+                                   tuple(values[station_id].stats()))
+
+
+def to_pixml(file_path_source, file_path_target, element_types=ELEMENT_TYPES,
+             element_type_units=ELEMENT_TYPE_UNITS, filters=None,
+             state=None):
+    """Writes a pixml per element type from one year file. With state, a
+    delta.ExportState, only the changes since the previous export are
+    written."""
+    values_per_element = read_file_elements(
+        file_path_source, element_types, filters=filters)
+    write_pixml(values_per_element, file_path_target, element_types,
+                element_type_units, state=state)
+
+
+def store_to_pixml(store_path, file_path_target, element_types=ELEMENT_TYPES,
+                   element_type_units=ELEMENT_TYPE_UNITS):
+    """Writes a pixml per element type straight from a store of one year."""
+    write_pixml(store.read_store(store_path, element_types), file_path_target,
+                element_types, element_type_units)
+
+
+def stores_to_pixml(store_paths, file_path_target,
+                    element_types=ELEMENT_TYPES,
+                    element_type_units=ELEMENT_TYPE_UNITS, state=None):
+    """
+    Writes a pixml per element type with one series per station stitched
+    together from the stores of all years in store_paths, one station at a
+    time. The stores of an element type are only opened when its pixml is
+    written.
+    """
+    for element_type in element_types:
+        write_pixml({element_type: store.MergedValues(store_paths,
+                                                      element_type)},
+                    file_path_target, [element_type], element_type_units,
+                    state=state)
+
+
+def archive_to_pixml(file_path_target, data_dir="data", store_dir="parsed",
+                     element_types=ELEMENT_TYPES,
+                     element_type_units=ELEMENT_TYPE_UNITS,
+                     first_year=FIRST_YEAR, last_year=None, workers=None,
+                     filters=None, state=None):
+    """
+    Downloads all years, parses each once into its own store and writes one
+    series per station and element type across the whole archive. With
+    state only the changes since the previous export are written.
+    """
+    filepaths = grab_files(data_dir, first_year, last_year)
+    store_paths = store_years(filepaths, store_dir, element_types, workers,
+                              filters=filters)
+    stores_to_pixml(store_paths, file_path_target, element_types,
+                    element_type_units, state)
+
+
+def backfill_to_pixml(file_path_target, data_dir="data",
+                      element_types=ELEMENT_TYPES,
+                      element_type_units=ELEMENT_TYPE_UNITS,
+                      first_year=FIRST_YEAR, last_year=None, workers=None,
+                      incremental=False, filters=None, state=None):
+    """Downloads and processes all years in parallel into one pixml per
+    element type. With incremental=True only the years that changed since
+    the last run are downloaded and processed, with state only the events
+    that changed since the previous export are written."""
+    values_per_element = read_files(element_types, data_dir, first_year,
+                                    last_year, workers,
+                                    incremental=incremental,
+                                    filters=filters)
+    write_pixml(values_per_element, file_path_target, element_types,
+                element_type_units, state=state)
 
 
 if __name__ == "__main__":
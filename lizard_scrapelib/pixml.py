@@ -1,9 +1,24 @@
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import gzip
+import json
 import os
 
 from lxml import etree
 from lxml import builder
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import series as series_
+except ImportError:
+    from lizard_scrapelib import series as series_
+
 
 def header(type="instantaneous", moduleInstanceId=None,
                           locationId=None, parameterId=None,
@@ -21,116 +36,559 @@ def header(type="instantaneous", moduleInstanceId=None,
         "type": type, "timeStep": timeStep, "missVal": missVal,
         "locationId": locationId, "parameterId": parameterId,
         "stationName": stationName, "lat": lat, "lon": lon, "units": units,
-        "startDate": None, "endDate": None
+        "startDate": kwargs.get("startDate"),
+        "endDate": kwargs.get("endDate")
     })
     if moduleInstanceId:
         kwargs.update({"moduleInstanceId": moduleInstanceId})
     return kwargs
 
 
-def write_xml_to_file(filename, tree):
-    with open(filename, 'a') as f:
-        f.write(
-            etree.tostring(
-                tree, pretty_print=True, xml_declaration=True, encoding='utf-8'
-            ).decode('utf-8')
-        )
+def events(values):
+    """
+    Yields (date_time, value, flag) for a Series or a list of event dicts.
+    """
+    if isinstance(values, series_.Series):
+        for timestamp, value, flag in zip(
+                values.times, values.values, values.flags):
+            yield (series_.from_timestamp(timestamp),
+                   series_.float32_value(value), flag)
+    else:
+        for value in values:
+            yield value["datetime"], value["value"], value["flag"]
+
+
+SCHEMA = "http://www.wldelft.nl/fews/PI"
+XSI = "http://www.w3.org/2001/XMLSchema-instance"
+SCHEMA_LOCATION = "http://www.wldelft.nl/fews/PI http://fews.wldelft.nl/" \
+                  "schemas/version1.0/pi-schemas/pi_timeseries.xsd"
+HEADER_ORDER = ["type", "moduleInstanceId", "locationId", "parameterId",
+                "timeStep", "startDate", "endDate", "missVal", "stationName",
+                "lat", "lon", "units"]
+
+Element = builder.ElementMaker()
+
+
+def date_time_attributes(date_time):
+    date, time = date_time.strftime('%Y-%m-%d %H:%M:%S').split(' ')
+    return {"date": date, "time": time}
+
+
+def date_range(values):
+    """First and last datetime of a Series or a list of event dicts."""
+    if isinstance(values, series_.Series):
+        stats = values.stats()
+        return stats.start, stats.end
+    dates = [value["datetime"] for value in values]
+    if not dates:
+        return None, None
+    return min(dates), max(dates)
+
 
+def escape_attribute(text):
+    """Escapes an attribute value the way lxml serialises it."""
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace(
+        '>', '&gt;').replace('"', '&quot;').replace('\n', '&#10;').replace(
+        '\r', '&#13;').replace('\t', '&#9;')
 
-def create(headerdicts, values, filename="pixml_for_lizard.xml", timeZone=0.0):
+
+class EventSerializer(object):
     """
-    Args:
-        values(iterable): [(date_time, value, flag), ...]
-        headerdicts(iterable): [{*}, ...]
-            * one of the Headerelements below with a value
-    """
-    schema = "http://www.wldelft.nl/fews/PI"
-    xsi = "http://www.w3.org/2001/XMLSchema-instance"
-    Element = builder.ElementMaker(nsmap={None: schema, 'xsi': xsi})
-    TimeZone = Element.timeZone
-    Root = Element.TimeSeries
-    Event = Element.event
-    Series = Element.series
-    Header = Element.header
-    Headerelements = {
-        'type': Element.type,
-        'moduleInstanceId': Element.moduleInstanceId,
-        'locationId': Element.locationId,
-        'parameterId': Element.parameterId,
-        'timeStep': Element.timeStep,
-        'startDate': Element.startDate,
-        'endDate': Element.endDate,
-        'missVal': Element.missVal,
-        'stationName': Element.stationName,
-        'lat': Element.lat,
-        'lon': Element.lon,
-        'x': Element.x,
-        'y': Element.y,
-        'units': Element.units
-    }
-
-    order = ["type", "moduleInstanceId", "locationId", "parameterId",
-             "timeStep", "startDate", "endDate", "missVal", "stationName",
-             "lat", "lon", "units"]
-    header_order = [
-        x for x in order if x in next(iter(headerdicts.values()))]
-    for key in list(values.keys()):
-        valueelements = values[key]
-        headerelements = headerdicts[key]
-        print('processing', key)
-        event_elements = []
-        min_date = datetime.datetime.now()
-        max_date = datetime.datetime(1, 1, 1)
-        for value in valueelements:
-            min_date = min(min_date, value["datetime"])
-            max_date = max(max_date, value["datetime"])
-            date, time = value["datetime"].strftime(
-                '%Y-%m-%d %H:%M:%S').split(' ')
-            event_elements.append(Event(date=date,
-                                        time=time,
-                                        value=str(value["value"]),
-                                        flag=str(value["flag"])))
-        header_elements = []
-        for name in header_order:
-            value = None
+    Serialises events straight to bytes, identical to what lxml writes for
+    an event element. Date, time, value and flag fragments are cached, so a
+    day is formatted once and a value once per distinct float32 value.
+    """
+    EVENTS_PER_WRITE = 4096
+    CACHE_SIZE = 2 ** 16
+
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+        self.dates = {}
+        self.times = {}
+        self.values = {}
+        self.flags = {}
+
+    def date(self, date_time):
+        return ('\n    <event date="' + date_time_attributes(date_time)[
+            "date"] + '" time="').encode(self.encoding)
+
+    def time(self, date_time):
+        return (date_time_attributes(date_time)["time"] + '" value="').encode(
+            self.encoding)
+
+    def value(self, value):
+        return escape_attribute(str(value)).encode(self.encoding)
+
+    def flag(self, flag):
+        return ('" flag="' + escape_attribute(str(flag)) + '"/>').encode(
+            self.encoding)
+
+    def cached(self, cache, key, format, argument):
+        fragment = cache.get(key)
+        if fragment is None:
+            if len(cache) >= self.CACHE_SIZE:
+                cache.clear()
+            fragment = cache[key] = format(argument)
+        return fragment
+
+    def fragments(self, values):
+        """Yields the bytes of every event of a Series or list of dicts."""
+        cached = self.cached
+        dates, times, values_, flags = (
+            self.dates, self.times, self.values, self.flags)
+        if isinstance(values, series_.Series):
+            # Values are cached on their float32 bits: 0.0 and -0.0 are
+            # equal as floats but not as text, and NaN never equals itself.
+            bits = memoryview(values.values).cast('B').cast('I')
+            for timestamp, value, key, flag in zip(
+                    values.times, values.values, bits, values.flags):
+                day, seconds = divmod(timestamp, 86400)
+                date = dates.get(day)
+                if date is None:
+                    date = cached(dates, day, self.date,
+                                  series_.from_timestamp(timestamp))
+                time = times.get(seconds)
+                if time is None:
+                    time = cached(times, seconds, self.time,
+                                  series_.from_timestamp(timestamp))
+                text = values_.get(key)
+                if text is None:
+                    text = cached(values_, key, self.value,
+                                  series_.float32_value(value))
+                flag_text = flags.get(flag)
+                if flag_text is None:
+                    flag_text = cached(flags, flag, self.flag, flag)
+                yield date + time + text + flag_text
+        else:
+            for date_time, value, flag in events(values):
+                yield (cached(dates, date_time.date(), self.date, date_time) +
+                       cached(times, date_time.time(), self.time, date_time) +
+                       self.value(value) + self.flag(flag))
+
+    def write(self, f, values):
+        chunk = []
+        for fragment in self.fragments(values):
+            chunk.append(fragment)
+            if len(chunk) >= self.EVENTS_PER_WRITE:
+                f.write(b''.join(chunk))
+                chunk = []
+        if chunk:
+            f.write(b''.join(chunk))
+
+
+def write_header(xf, headerelements, start_date, end_date):
+    with xf.element('header'):
+        for name in HEADER_ORDER:
+            if name not in headerelements:
+                continue
             if name == "startDate":
-                date, time = min_date.strftime('%Y-%m-%d %H:%M:%S').split(' ')
-                val_dict = {"date": date, "time": time}
+                element = Element(name, **date_time_attributes(start_date))
             elif name == "endDate":
-                date, time = max_date.strftime('%Y-%m-%d %H:%M:%S').split(' ')
-                val_dict = {"date": date, "time": time}
+                element = Element(name, **date_time_attributes(end_date))
             elif name == "timeStep":
-                val_dict = headerelements[name]
+                element = Element(name, **{
+                    k: str(v) for k, v in headerelements[name].items()})
             else:
-                value = str(headerelements[name])
-            if value:
-                header_elements.append(Headerelements[name](value))
+                element = Element(name, str(headerelements[name]))
+            xf.write('\n      ', element)
+        xf.write('\n    ')
+
+
+def write_series(xf, headerelements, valueelements, f=None,
+                 serializer=None):
+    """
+    Writes one series to an open xmlfile. Events are written one by one as
+    they come from valueelements, so it can be any iterable as long as the
+    header has a startDate and endDate.
+
+    With an EventSerializer and the file f underneath xf, events bypass
+    lxml and are written to f as bytes after flushing xf. A series without
+    events writes nothing, not even the whitespace in front of it.
+    """
+    start_date = headerelements.get("startDate")
+    end_date = headerelements.get("endDate")
+    if start_date is None or end_date is None:
+        if not isinstance(valueelements, (series_.Series, list, tuple)):
+            valueelements = list(valueelements)
+        start_date, end_date = date_range(valueelements)
+        if start_date is None:
+            print('skipping {}, it has no events'.format(
+                headerelements["locationId"]))
+            return False
+    xf.write('\n  ')
+    with xf.element('series'):
+        xf.write('\n    ')
+        write_header(xf, headerelements, start_date, end_date)
+        if serializer is not None and f is not None:
+            xf.flush()
+            serializer.write(f, valueelements)
+        else:
+            for date_time, value, flag in events(valueelements):
+                attributes = date_time_attributes(date_time)
+                attributes.update(value=str(value), flag=str(flag))
+                xf.write('\n    ', Element.event(attributes))
+        xf.write('\n  ')
+    return True
+
+
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+@contextlib.contextmanager
+def open_output(filename, compression=None):
+    """
+    Opens filename for writing, compressed on the fly with gzip or zstd.
+    Yields the file to write to and the file on disk.
+    """
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError("Unknown compression {}, choose one of {}".format(
+            compression, ', '.join(map(str, COMPRESSION_EXTENSIONS))))
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError("zstd compression needs zstandard to be installed")
+    with open(filename, 'wb') as raw:
+        if compression == 'gzip':
+            with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as f:
+                yield f, raw
+        elif compression == 'zstd':
+            with zstandard.ZstdCompressor().stream_writer(
+                    raw, closefd=False) as f:
+                yield f, raw
+        else:
+            yield raw, raw
+
+
+def write_document(filename, headerdicts, values, keys, timeZone=0.0,
+                   max_series=None, max_bytes=None, compression=None,
+                   serializer="fast", state=None):
+    """
+    Writes a complete TimeSeries document with the series for keys, in
+    order, until max_series series are written or the file on disk has
+    grown past max_bytes. The byte size is checked between series and lags
+    behind by what lxml and the compressor still buffer, a series is never
+    split. With a delta.ExportState only the changed events of every series
+    are written.
+
+    Returns:
+        (number of keys handled, locationIds written)
+    """
+    handled = 0
+    location_ids = []
+    with open_output(filename, compression) as (f, raw), \
+            etree.xmlfile(f, encoding='utf-8') as xf:
+        # The fast path needs xmlfile.flush to keep lxml's output in order.
+        event_serializer = EventSerializer() if (
+            serializer == "fast" and hasattr(xf, 'flush')) else None
+        xf.write_declaration()
+        root_attributes = {
+            "{{{pre}}}schemaLocation".format(pre=XSI): SCHEMA_LOCATION,
+            "version": "1.17"
+        }
+        with xf.element('TimeSeries', root_attributes,
+                        nsmap={None: SCHEMA, 'xsi': XSI}):
+            xf.write('\n  ', Element.timeZone(str(timeZone)))
+            for key in keys:
+                print('processing', key)
+                headerelements = headerdicts[key]
+                valueelements = values.pop(key)
+                if state is not None:
+                    valueelements = state.delta(
+                        headerelements["locationId"],
+                        headerelements["parameterId"], valueelements)
+                    headerelements = dict(headerelements, startDate=None,
+                                          endDate=None)
+                handled += 1
+                if write_series(xf, headerelements, valueelements, f,
+                                event_serializer):
+                    location_ids.append(headerelements["locationId"])
+                if (max_series and len(location_ids) >= max_series) or \
+                        (max_bytes and raw.tell() >= max_bytes):
+                    break
+            xf.write('\n')
+    return handled, location_ids
+
+
+def create(headerdicts, values, filename="pixml_for_lizard.xml", timeZone=0.0,
+           max_series=None, max_bytes=None, compression=None,
+           serializer="fast", state=None):
+    """
+    Streams all series to filename with lxml's incremental xmlfile writer.
+    Events are never kept in memory as elements and the values of every
+    series are released once it is written. Headers are only looked up for
+    the keys in values.
+
+    With max_series or max_bytes the output is split into shards named
+    <filename>_0000.xml, <filename>_0001.xml, ..., each a complete
+    TimeSeries document, and <filename>.index.json lists the locationIds in
+    every shard.
+
+    With compression "gzip" or "zstd" (needs zstandard) every file is
+    compressed while it is written and gets a .gz or .zst extension.
+
+    Events are serialised by EventSerializer unless serializer is "lxml",
+    the output is byte for byte the same.
+
+    With state (a delta.ExportState) every series only gets the events of
+    the months that are new or changed since the previous export with that
+    state, series without changes are left out.
+
+    Args:
+        values(dict): {locationId: series.Series, [{datetime, value,
+            flag}, ...] or an iterator of those dicts}
+        headerdicts(mapping): {locationId: {*}}
+            * one of the HEADER_ORDER elements with a value, see header()
+        max_series(int): maximum number of series per shard.
+        max_bytes(int): size in bytes on disk after which a new shard is
+            started.
+        compression(str): None, "gzip" or "zstd".
+        serializer(str): "fast" or "lxml".
+        state(delta.ExportState): state of the previous exports.
+
+    Returns:
+        list of the files written.
+    """
+    keys = list(values.keys())
+    compression_extension = COMPRESSION_EXTENSIONS.get(compression, '')
+    if compression_extension and filename.endswith(compression_extension):
+        filename = filename[:-len(compression_extension)]
+    if not max_series and not max_bytes:
+        filename += compression_extension
+        write_document(filename, headerdicts, values, keys, timeZone,
+                       compression=compression, serializer=serializer,
+                       state=state)
+        return [filename]
+    base, extension = os.path.splitext(filename)
+    extension = (extension or '.xml') + compression_extension
+    shards = []
+    index = {}
+    start = 0
+    while start < len(keys) or not shards:
+        shard = '{}_{:04d}{}'.format(base, len(shards), extension)
+        handled, location_ids = write_document(
+            shard, headerdicts, values, keys[start:], timeZone, max_series,
+            max_bytes, compression, serializer, state)
+        start += handled
+        shards.append(shard)
+        index[os.path.basename(shard)] = location_ids
+    with open(base + '.index.json', 'w') as index_file:
+        json.dump(index, index_file, indent=1)
+    return shards
+
+
+def upload_shards(filenames, upload, workers=4):
+    """
+    Calls upload(filename) for every shard from a pool of workers threads
+    and returns the results in the order of filenames.
+    """
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(upload, filenames))
+
+
+@contextlib.contextmanager
+def open_input(filename):
+    """Opens a PI-XML file for reading, .gz and .zst files are decompressed
+    while they are read."""
+    if filename.endswith(COMPRESSION_EXTENSIONS['gzip']):
+        with gzip.open(filename, 'rb') as f:
+            yield f
+    elif filename.endswith(COMPRESSION_EXTENSIONS['zstd']):
+        if zstandard is None:
+            raise ImportError("reading .zst files needs zstandard to be "
+                              "installed")
+        with open(filename, 'rb') as raw, \
+                zstandard.ZstdDecompressor().stream_reader(raw) as f:
+            yield f
+    else:
+        with open(filename, 'rb') as f:
+            yield f
+
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def parse_header(element):
+    """
+    Header dict as made by header() from a header element. startDate and
+    endDate become datetimes, all other values are kept as text.
+    """
+    headerelements = {}
+    for child in element:
+        name = local_name(child.tag)
+        if name in ("startDate", "endDate"):
+            headerelements[name] = datetime.datetime.strptime(
+                child.get("date") + ' ' + child.get("time"),
+                '%Y-%m-%d %H:%M:%S')
+        elif name == "timeStep":
+            headerelements[name] = dict(child.attrib)
+        else:
+            headerelements[name] = child.text
+    return headerelements
+
+
+class EventParser(object):
+    """
+    Turns the date, time, value and flag attributes of event elements into
+    Series columns. Like EventSerializer it caches the date and time
+    strings, so a day is parsed once.
+    """
+    def __init__(self):
+        self.days = {}
+        self.seconds = {}
+
+    def day(self, date):
+        timestamp = self.days.get(date)
+        if timestamp is None:
+            timestamp = self.days[date] = series_.to_timestamp(
+                datetime.datetime.strptime(date, '%Y-%m-%d'))
+        return timestamp
+
+    def second(self, time):
+        seconds = self.seconds.get(time)
+        if seconds is None:
+            hours, minutes, seconds = time.split(':')
+            seconds = self.seconds[time] = (
+                int(hours) * 3600 + int(minutes) * 60 + int(seconds))
+        return seconds
+
+    def append(self, values, element):
+        get = element.get
+        values.append(self.day(get("date")) + self.second(get("time")),
+                      float(get("value")), int(get("flag", 0)))
+
+
+def clear(element):
+    """Frees an element that has been read and the siblings before it."""
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+def read(filename):
+    """
+    Streams the series of a PI-XML file (optionally .gz or .zst) with
+    iterparse. Every event element is added to a Series and cleared right
+    away, so memory holds the current series' columns and not the document.
+
+    Yields:
+        (headerelements, series.Series) per series, see parse_header for
+        the header dict.
+    """
+    series_tag = '{%s}series' % SCHEMA
+    header_tag = '{%s}header' % SCHEMA
+    event_tag = '{%s}event' % SCHEMA
+    event_parser = EventParser()
+    with open_input(filename) as f:
+        headerelements, values = None, None
+        for action, element in etree.iterparse(
+                f, events=('start', 'end'),
+                tag=(series_tag, header_tag, event_tag)):
+            if action == 'start':
+                if element.tag == series_tag:
+                    headerelements, values = {}, series_.Series()
+                continue
+            if element.tag == event_tag:
+                event_parser.append(values, element)
+            elif element.tag == header_tag:
+                headerelements = parse_header(element)
+                if headerelements.get("missVal") is not None:
+                    values.missing_value = float(headerelements["missVal"])
             else:
-                header_elements.append(Headerelements[name](**val_dict))
-        header = Header(*header_elements)
-        series = Series(header, *event_elements)
-        print('removing {}'.format(key))
-        del values[key]
-        del headerdicts[key]
-        write_xml_to_file(filename + '.tmp', series)
-    timeZone = TimeZone(str(timeZone))
-    root = Root(timeZone)
-    root.attrib['{{{pre}}}schemaLocation'.format(pre=xsi)] = \
-        "http://www.wldelft.nl/fews/PI http://fews.wldelft.nl/schemas/" \
-        "version1.0/pi-schemas/pi_timeseries.xsd"
-    root.attrib['version'] = "1.17"
-    root_string = etree.tostring(
-        root, pretty_print=True, xml_declaration=True, encoding='utf-8'
-    ).decode('utf-8')
-    begin = '\n'.join(root_string.split('\n')[:3])
-    end = '\n'.join(root_string.split('\n')[3:])
-    with open(filename, 'w') as f:
-        f.write(begin)
-        with open(filename + '.tmp', 'r') as f2:
-            for line in f2:
-                f.write(line)
-        f.write(end)
-    os.remove(filename + '.tmp')
+                yield headerelements, values
+            clear(element)
+
+
+def series_key(headerelements):
+    return headerelements.get("locationId"), headerelements.get("parameterId")
+
+
+Difference = collections.namedtuple(
+    'Difference', ['locationId', 'parameterId', 'added', 'removed',
+                   'changed'])
 
 
+def diff_events(old, new):
+    """
+    Compares two Series sorted on time event by event.
+
+    Yields:
+        (timestamp, old (value, flag) or None, new (value, flag) or None)
+        for every event that was added, removed or changed.
+    """
+    old_events = zip(old.times, old.values, old.flags)
+    new_events = zip(new.times, new.values, new.flags)
+    old_event = next(old_events, None)
+    new_event = next(new_events, None)
+    while old_event is not None or new_event is not None:
+        if new_event is None or (
+                old_event is not None and old_event[0] < new_event[0]):
+            yield old_event[0], old_event[1:], None
+            old_event = next(old_events, None)
+        elif old_event is None or new_event[0] < old_event[0]:
+            yield new_event[0], None, new_event[1:]
+            new_event = next(new_events, None)
+        else:
+            if old_event[1:] != new_event[1:]:
+                yield old_event[0], old_event[1:], new_event[1:]
+            old_event = next(old_events, None)
+            new_event = next(new_events, None)
+
+
+def difference(key, old, new):
+    added = removed = changed = 0
+    for _, old_event, new_event in diff_events(old, new):
+        if old_event is None:
+            added += 1
+        elif new_event is None:
+            removed += 1
+        else:
+            changed += 1
+    return Difference(key[0], key[1], added, removed, changed)
+
+
+def diff(old_filename, new_filename):
+    """
+    Streams two PI-XML files side by side and compares their series per
+    locationId and parameterId. Series that come in the same order in both
+    files are compared as they are read; a series without a counterpart yet
+    is kept until it shows up, so only reordered series cost memory.
+
+    Yields:
+        Difference with the number of added, removed and changed events for
+        every series that differs.
+    """
+    pending = ({}, {})
+    readers = [read(old_filename), read(new_filename)]
+    while any(readers):
+        for side, reader in enumerate(readers):
+            if reader is None:
+                continue
+            item = next(reader, None)
+            if item is None:
+                readers[side] = None
+                continue
+            headerelements, values = item
+            values.sort()
+            key = series_key(headerelements)
+            other = pending[1 - side].pop(key, None)
+            if other is None:
+                pending[side][key] = values
+                continue
+            old, new = (values, other) if side == 0 else (other, values)
+            result = difference(key, old, new)
+            if result.added or result.removed or result.changed:
+                yield result
+    for key, values in pending[0].items():
+        yield Difference(key[0], key[1], 0, len(values), 0)
+    for key, values in pending[1].items():
+        yield Difference(key[0], key[1], len(values), 0, 0)
+
 
+def print_diff(old_filename, new_filename):
+    """Prints the differences between two PI-XML files per series and
+    returns the number of series that differ."""
+    differences = 0
+    for result in diff(old_filename, new_filename):
+        differences += 1
+        print('{} {}: {} added, {} removed, {} changed'.format(*result))
+    print('{} series differ'.format(differences))
+    return differences
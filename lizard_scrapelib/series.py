@@ -0,0 +1,149 @@
+import array
+import collections
+import datetime
+
+EPOCH = datetime.datetime(1970, 1, 1)
+SECOND = datetime.timedelta(seconds=1)
+MISSING_VALUE = -999.0
+
+Stats = collections.namedtuple(
+    'Stats', ['start', 'end', 'count', 'missing', 'min', 'max'])
+
+
+def to_timestamp(date_time):
+    """Seconds since 1970-01-01 for a naive datetime."""
+    return (date_time - EPOCH) // SECOND
+
+
+def from_timestamp(timestamp):
+    """Naive datetime for seconds since 1970-01-01 (also before 1970)."""
+    return EPOCH + datetime.timedelta(seconds=timestamp)
+
+
+def float32_value(value):
+    """Shortest float that survives storage as a float32 value."""
+    return float('%.7g' % value)
+
+
+class Series(object):
+    """
+    Columnar store for the events of one timeseries.
+
+    Times are kept as int64 epoch seconds, values as float32 and flags as
+    uint8 in ``array.array`` columns; 13 bytes per event instead of a dict
+    per event. Iterating over a Series yields the same
+    ``{"datetime", "value", "flag"}`` dicts the scrapers used to build, so
+    it can be handed to ``pixml.create`` as is.
+
+    Summary statistics (see ``stats``) are computed over the columns once
+    and kept until the Series changes, so add events through the methods
+    below rather than on the columns themselves.
+    """
+    __slots__ = ('times', 'values', 'flags', 'missing_value', '_stats')
+
+    def __init__(self, times=(), values=(), flags=(),
+                 missing_value=MISSING_VALUE):
+        self.times = array.array('q', times)
+        self.values = array.array('f', values)
+        self.flags = array.array('B', flags)
+        self.missing_value = missing_value
+        self._stats = None
+
+    @classmethod
+    def from_events(cls, events):
+        """Builds a Series from an iterable of event dicts."""
+        series = cls()
+        for event in events:
+            series.append_datetime(
+                event["datetime"], float(event["value"]), event["flag"])
+        return series
+
+    def append(self, timestamp, value, flag=0):
+        self.times.append(timestamp)
+        self.values.append(value)
+        self.flags.append(flag)
+        self._stats = None
+
+    def append_datetime(self, date_time, value, flag=0):
+        self.append(to_timestamp(date_time), value, flag)
+
+    def extend(self, other):
+        self.times.extend(other.times)
+        self.values.extend(other.values)
+        self.flags.extend(other.flags)
+        self._stats = None
+
+    def frombytes(self, times, values, flags):
+        """Appends events from the raw bytes of the three columns."""
+        self.times.frombytes(times)
+        self.values.frombytes(values)
+        self.flags.frombytes(flags)
+        self._stats = None
+
+    def sort(self):
+        """Sorts the events on time, events at the same time keep their
+        order."""
+        if all(a <= b for a, b in zip(self.times, self.times[1:])):
+            return
+        order = sorted(range(len(self.times)), key=self.times.__getitem__)
+        self.times = array.array('q', (self.times[i] for i in order))
+        self.values = array.array('f', (self.values[i] for i in order))
+        self.flags = array.array('B', (self.flags[i] for i in order))
+
+    def stats(self):
+        """
+        Summary of the Series: first and last datetime, number of events,
+        number of missing values and the smallest and largest value that is
+        not missing.
+
+        Returns:
+            Stats namedtuple; start, end, min and max are None when there
+            is nothing to report.
+        """
+        if self._stats is None:
+            self._stats = self._compute_stats()
+        return self._stats
+
+    def _compute_stats(self):
+        if not len(self.times):
+            return Stats(None, None, 0, 0, None, None)
+        missing_value = array.array('f', [self.missing_value])[0]
+        missing = self.values.count(missing_value)
+        values = self.values
+        if missing:
+            values = [value for value in values if value != missing_value]
+        return Stats(
+            from_timestamp(min(self.times)),
+            from_timestamp(max(self.times)),
+            len(self.times),
+            missing,
+            float32_value(min(values)) if values else None,
+            float32_value(max(values)) if values else None)
+
+    def datetimes(self):
+        return (from_timestamp(timestamp) for timestamp in self.times)
+
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in
+                   (self.times, self.values, self.flags))
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        for timestamp, value, flag in zip(
+                self.times, self.values, self.flags):
+            yield {
+                "datetime": from_timestamp(timestamp),
+                "value": float32_value(value),
+                "flag": flag
+            }
+
+    def __eq__(self, other):
+        if not isinstance(other, Series):
+            return NotImplemented
+        return (self.times == other.times and self.values == other.values
+                and self.flags == other.flags)
+
+    def __repr__(self):
+        return '<Series with {} events>'.format(len(self))
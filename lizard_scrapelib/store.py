@@ -0,0 +1,191 @@
+"""
+Station partitioned binary store for parsed series.
+
+Every element type gets a directory with three column files (times.bin as
+int64 epoch seconds, values.bin as float32, flags.bin as uint8) and an
+index.json with the offset and length of each station in those columns.
+Stations are written in ID order with their events sorted on time, so a
+station is a contiguous slice that is read with one seek per column.
+
+Stores of several years are sorted runs that MergedValues and merge_stores
+combine with a k-way merge into one series per station.
+"""
+import array
+import collections.abc
+import heapq
+import itertools
+import json
+import os
+import sys
+
+try:
+    import series as series_
+except ImportError:
+    from lizard_scrapelib import series as series_
+
+COLUMNS = (("times", "q"), ("values", "f"), ("flags", "B"))
+ITEMSIZES = tuple((name, array.array(typecode).itemsize)
+                  for name, typecode in COLUMNS)
+
+
+def write_element(element_path, items):
+    """
+    Writes (station_id, series.Series) items for one element type, in the
+    order they come, to the store directory element_path. Only one Series
+    is held at a time. The Series are sorted on time in place.
+    """
+    os.makedirs(element_path, exist_ok=True)
+    index = {}
+    offset = 0
+    files = {name: open(os.path.join(element_path, name + '.bin'), 'wb')
+             for name, _ in COLUMNS}
+    try:
+        for station_id, values in items:
+            values.sort()
+            for name, _ in COLUMNS:
+                getattr(values, name).tofile(files[name])
+            index[station_id] = [offset, len(values)]
+            offset += len(values)
+    finally:
+        for column_file in files.values():
+            column_file.close()
+    with open(os.path.join(element_path, 'index.json'), 'w') as f:
+        json.dump({"byteorder": sys.byteorder, "stations": index}, f)
+
+
+def write_store(path, values_per_element):
+    """
+    Writes {element_type: {station_id: series.Series}} to the store at path.
+    The Series are sorted on time in place.
+    """
+    for element_type, values_all_stations in values_per_element.items():
+        write_element(
+            os.path.join(path, element_type),
+            ((station_id, values_all_stations[station_id])
+             for station_id in sorted(values_all_stations)))
+
+
+class StoredValues(collections.abc.Mapping):
+    """
+    Read only {station_id: series.Series} view on one element type of a
+    store. A Series is read from the column files when it is looked up;
+    no files are kept open in between, so views on hundreds of stores can
+    exist at the same time without running out of file descriptors.
+    """
+
+    def __init__(self, element_path):
+        with open(os.path.join(element_path, 'index.json'), 'r') as f:
+            index = json.load(f)
+        if index["byteorder"] != sys.byteorder:
+            raise ValueError("Store {} was written with {} byte order".format(
+                element_path, index["byteorder"]))
+        self.element_path = element_path
+        self.index = index["stations"]
+
+    def read_column(self, name, size, offset, length):
+        with open(os.path.join(self.element_path, name + '.bin'), 'rb') as f:
+            f.seek(offset * size)
+            return f.read(length * size)
+
+    def __getitem__(self, station_id):
+        offset, length = self.index[station_id]
+        values = series_.Series()
+        values.frombytes(*(self.read_column(name, size, offset, length)
+                           for name, size in ITEMSIZES))
+        return values
+
+    def pop(self, station_id):
+        return self[station_id]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def stored_element_types(path):
+    return sorted(name for name in os.listdir(path) if os.path.exists(
+        os.path.join(path, name, 'index.json')))
+
+
+def read_store(path, element_types=None):
+    """{element_type: StoredValues} for the element types in the store at
+    path."""
+    if element_types is None:
+        element_types = stored_element_types(path)
+    return {element_type: StoredValues(os.path.join(path, element_type))
+            for element_type in element_types}
+
+
+def merge_series(parts):
+    """
+    One Series from parts that are each sorted on time. Parts that follow
+    each other in time are concatenated, overlapping parts are merged
+    event by event, equal times keep the order of parts.
+    """
+    merged = series_.Series()
+    if all(not len(before) or not len(after) or
+           before.times[-1] <= after.times[0]
+           for before, after in zip(parts, parts[1:])):
+        for part in parts:
+            merged.extend(part)
+        return merged
+    for timestamp, value, flag in heapq.merge(
+            *(zip(part.times, part.values, part.flags) for part in parts),
+            key=lambda event: event[0]):
+        merged.append(timestamp, value, flag)
+    return merged
+
+
+class MergedValues(collections.abc.Mapping):
+    """
+    Read only {station_id: series.Series} view over one element type in
+    several stores, e.g. one per year. Stations are iterated in ID order
+    with a k-way merge over the sorted station indexes of the stores, and a
+    station's Series is stitched together from all stores when it is
+    looked up. Memory stays bounded by a single station's history however
+    many stores there are.
+    """
+
+    def __init__(self, paths, element_type):
+        self.stores = [
+            StoredValues(os.path.join(path, element_type)) for path in paths
+            if os.path.exists(os.path.join(path, element_type, 'index.json'))]
+
+    def __getitem__(self, station_id):
+        parts = [stored[station_id] for stored in self.stores
+                 if station_id in stored.index]
+        if not parts:
+            raise KeyError(station_id)
+        return merge_series(parts)
+
+    def pop(self, station_id):
+        return self[station_id]
+
+    def __iter__(self):
+        station_ids = heapq.merge(
+            *(sorted(stored.index) for stored in self.stores))
+        return (station_id for station_id, _ in itertools.groupby(
+            station_ids))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def merge_stores(paths, path, element_types=None):
+    """
+    Consolidates the stores at paths (in time order, e.g. one per year)
+    into a single store at path with one time ordered Series per station
+    and element type, streaming one station at a time.
+    """
+    if element_types is None:
+        element_types = sorted(set(
+            element_type for store_path in paths
+            for element_type in stored_element_types(store_path)))
+    for element_type in element_types:
+        print('merging', element_type)
+        merged = MergedValues(paths, element_type)
+        write_element(os.path.join(path, element_type),
+                      ((station_id, merged[station_id])
+                       for station_id in merged))
@@ -0,0 +1,137 @@
+"""
+Tests for fetch against a local HTTP server that serves fixture pages.
+"""
+import http.server
+import threading
+import time
+import urllib.error
+
+import pytest
+
+from lizard_scrapelib import fetch
+
+PAGES = {"/page/{}".format(number): "page {}".format(number).encode('utf-8')
+         for number in range(20)}
+ETAG = '"fixture"'
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(
+            (self.path, self.client_address, time.monotonic(),
+             self.headers.get("If-None-Match")))
+        if self.path.startswith('/old/'):
+            self.send_response(301)
+            self.send_header("Location", '/page/' + self.path[5:])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = PAGES.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.send_header("ETag", ETAG)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    server.daemon_threads = True
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_map_keeps_order(server):
+    urls = [server.url + path for path in PAGES]
+    with fetch.Fetcher(workers=8, requests_per_second=None) as fetcher:
+        pages = list(fetcher.map(urls))
+    assert pages == [body.decode('utf-8') for body in PAGES.values()]
+
+
+def test_connections_are_reused(server):
+    urls = [server.url + path for path in PAGES] * 2
+    with fetch.Fetcher(workers=8, connections=4,
+                       requests_per_second=None) as fetcher:
+        list(fetcher.map(urls))
+    clients = set(client for _, client, _, _ in server.requests)
+    assert len(server.requests) == len(urls)
+    assert len(clients) <= 4
+
+
+def test_missing_page_raises_http_error(server):
+    with fetch.Fetcher(requests_per_second=None) as fetcher:
+        with pytest.raises(urllib.error.HTTPError) as error:
+            fetcher.text(server.url + '/missing')
+    assert error.value.code == 404
+
+
+def test_redirects_are_followed(server):
+    with fetch.Fetcher(requests_per_second=None) as fetcher:
+        response = fetcher.get(server.url + '/old/3')
+    assert response.status == 200
+    assert response.url == server.url + '/page/3'
+    assert response.body == PAGES['/page/3']
+
+
+def test_rate_limit(server):
+    urls = [server.url + path for path in list(PAGES)[:6]]
+    with fetch.Fetcher(workers=6, requests_per_second=20.0) as fetcher:
+        list(fetcher.map(urls))
+    starts = sorted(start for _, _, start, _ in server.requests)
+    assert starts[-1] - starts[0] >= 5 / 20.0 * 0.9
+
+
+def test_cache_revalidates(server, tmp_path):
+    url = server.url + '/page/1'
+    cache = fetch.Cache(str(tmp_path))
+    with fetch.Fetcher(requests_per_second=None, cache=cache) as fetcher:
+        assert fetcher.text(url) == 'page 1'
+        assert fetcher.text(url) == 'page 1'
+    assert [etag for _, _, _, etag in server.requests] == [None, ETAG]
+
+
+def test_cache_offline(server, tmp_path):
+    url = server.url + '/page/1'
+    with fetch.Fetcher(requests_per_second=None,
+                       cache=fetch.Cache(str(tmp_path))) as fetcher:
+        fetcher.text(url)
+    with fetch.Fetcher(cache=fetch.Cache(str(tmp_path),
+                                         offline=True)) as fetcher:
+        assert fetcher.text(url) == 'page 1'
+        with pytest.raises(urllib.error.URLError):
+            fetcher.text(server.url + '/page/2')
+    assert len(server.requests) == 1
+
+
+def test_cache_keeps_redirected_pages_under_requested_url(server, tmp_path):
+    url = server.url + '/old/4'
+    with fetch.Fetcher(requests_per_second=None, cache=fetch.Cache(
+            str(tmp_path), max_age=3600)) as fetcher:
+        assert fetcher.text(url) == 'page 4'
+        assert fetcher.text(url) == 'page 4'
+    with fetch.Fetcher(cache=fetch.Cache(str(tmp_path),
+                                         offline=True)) as fetcher:
+        assert fetcher.text(url) == 'page 4'
+    assert [path for path, _, _, _ in server.requests] == ['/old/4',
+                                                           '/page/4']
@@ -0,0 +1,43 @@
+"""
+Importing the scraper modules stays cheap: no optional heavy dependencies,
+no credentials and no files written at import time.
+"""
+import json
+import os
+import subprocess
+import sys
+
+MODULES = ("lizard_scrapelib.noaa", "lizard_scrapelib.pixml",
+           "lizard_scrapelib.mrcmekong")
+NOT_LOADED = ("osgeo", "lizard_connector", "numpy")
+# Generous, the imports take well under a second on a laptop.
+IMPORT_SECONDS = 2.0
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "loaded": [name for name in {not_loaded!r} if name in sys.modules],
+    "credentials": hasattr(sys.modules.get("secrets"), "USR"),
+}}))
+"""
+
+
+def test_imports_are_cheap(tmp_path):
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=root)
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(modules=MODULES,
+                                             not_loaded=NOT_LOADED)],
+        cwd=str(tmp_path), env=env, check=True, stdout=subprocess.PIPE,
+        universal_newlines=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    assert result["loaded"] == []
+    assert not result["credentials"]
+    assert os.listdir(str(tmp_path)) == []
+    assert result["seconds"] < IMPORT_SECONDS
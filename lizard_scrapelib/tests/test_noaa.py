@@ -0,0 +1,44 @@
+"""
+Tests that the python and numpy parsers of noaa read the same Series.
+"""
+import io
+
+import pytest
+
+from lizard_scrapelib import noaa
+
+LINES = """\
+US1AB000001,19000101,TMAX,-0,,,7,
+US1AB000001,19000101,TMIN,-123,,,7,0700
+US1AB000001,19000102,TMAX,0,,,7,2359
+US1AB000001,19000102,PRCP,45,,X,7,
+US1AB000001,19000103,TMAX,17,,,7,2460
+US1AB000001,19000104,TMAX,-9999,,,7,12a0
+USC00000002,19691231,TMAX,250,,,7,070
+USC00000002,19700101,TMAX,-1,,I,7,1200
+USC00000002,19700101,SNOW,3,,,7,0000
+"""
+
+
+def parse(parser, block_size=noaa.BLOCK_SIZE):
+    buckets = {element_type: {} for element_type in ("TMAX", "TMIN",
+                                                     "PRCP")}
+    if parser == "numpy":
+        noaa.parse_lines_numpy(io.StringIO(LINES), buckets,
+                               block_size=block_size)
+    else:
+        noaa.parse_lines_python(io.StringIO(LINES), buckets)
+    return {(element_type, station_id): (
+        list(values.times), [value.hex() for value in values.values],
+        list(values.flags))
+        for element_type, stations in buckets.items()
+        for station_id, values in stations.items()}
+
+
+def test_parsers_read_the_same_series():
+    if noaa.import_numpy() is None:
+        pytest.skip("numpy is not installed")
+    expected = parse("python")
+    assert expected[("TMAX", "US1AB000001")][1][0] == (-0.0).hex()
+    assert parse("numpy") == expected
+    assert parse("numpy", block_size=64) == expected
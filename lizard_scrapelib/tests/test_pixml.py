@@ -0,0 +1,41 @@
+"""
+Tests for pixml's fast event serialiser against the lxml path.
+"""
+import datetime
+
+from lizard_scrapelib import pixml
+from lizard_scrapelib import series
+
+
+def header(location_id):
+    return {"locationId": location_id, "parameterId": "P",
+            "type": "instantaneous", "timeStep": {"unit": "day"},
+            "missVal": -999.0, "units": "mm"}
+
+
+def write(tmp_path, values, serializer):
+    filename = str(tmp_path / (serializer + '.xml'))
+    pixml.create({key: header(key) for key in values}, dict(values),
+                 filename, serializer=serializer)
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def test_fast_serializer_matches_lxml(tmp_path):
+    start = series.to_timestamp(datetime.datetime(1899, 12, 30, 6))
+    values = [0.0, -0.0, float('nan'), float('inf'), -float('inf'), 0.1,
+              -0.0, 0.0, float('nan'), 1e30, -999.0]
+    events = [{"datetime": datetime.datetime(1950, 1, day), "value": value,
+               "flag": flag}
+              for day, value, flag in ((1, 'a<b&"c"', 0), (2, -0.0, 1),
+                                       (3, 0.0, 'x>y'))]
+    values = {
+        "series": series.Series(
+            [start + i * 43200 for i in range(len(values))], values,
+            range(len(values))),
+        "dicts": events,
+    }
+    fast = write(tmp_path, values, "fast")
+    assert fast == write(tmp_path, values, "lxml")
+    assert b'value="-0.0"' in fast and b'value="nan"' in fast
+    assert b'date="1899-12-30"' in fast
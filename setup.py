@@ -32,6 +32,10 @@ setup(name='lizard-scrapelib',
       include_package_data=True,
       zip_safe=False,
       install_requires=install_requires,
+      extras_require={
+          'zstd': ['zstandard'],
+          'test': ['pytest'],
+      },
       entry_points={
           'console_scripts': [
           ]},